@@ -0,0 +1,252 @@
+import json
+import pandas as pd
+
+import cube_stations
+import meteofrance
+import stockage
+
+# Pas de temps des données par fréquence
+PAS_TEMPS = {
+    'horaire': pd.Timedelta(hours=1),
+    'quotidienne': pd.Timedelta(days=1)
+}
+
+def get_filepath_archive(client, frequence=None, fmt=None):
+    '''Chemin de l'archive de la donnée de toutes les stations téléchargées.'''
+    filename = f"archive_{client.api}"
+    if frequence is not None:
+        filename += f"_{frequence}"
+    filename += stockage.get_suffixe(fmt)
+    parent = meteofrance.DATA_DIR / client.api
+    parent.mkdir(parents=True, exist_ok=True)
+    filepath = parent / filename
+
+    return filepath
+
+def get_dossier_cube(client, frequence=None):
+    '''Dossier du cube (station, temps, variable) construit à partir de l'archive.'''
+    filepath_archive = get_filepath_archive(client, frequence=frequence)
+
+    return filepath_archive.with_name(
+        filepath_archive.stem.replace('archive', 'cube'))
+
+def get_filepath_catalogue(client, frequence=None):
+    '''Chemin du catalogue des périodes couvertes par l'archive, à côté de celle-ci.'''
+    filepath_archive = get_filepath_archive(client, frequence=frequence)
+    filepath = filepath_archive.with_name(
+        filepath_archive.stem.replace('archive', 'catalogue') + '.json')
+
+    return filepath
+
+def lire_catalogue(filepath):
+    '''Lecture du catalogue : intervalles fermés couverts par station.'''
+    catalogue = {}
+    if filepath.exists():
+        with open(filepath) as f:
+            catalogue = {
+                id_station: [(pd.Timestamp(deb), pd.Timestamp(fin))
+                             for deb, fin in intervalles]
+                for id_station, intervalles in json.load(f).items()}
+
+    return catalogue
+
+def ecrire_catalogue(catalogue, filepath):
+    '''Écriture du catalogue des périodes couvertes.'''
+    catalogue_str = {
+        id_station: [[deb.isoformat(), fin.isoformat()]
+                     for deb, fin in intervalles]
+        for id_station, intervalles in catalogue.items()}
+    filepath_tmp = filepath.with_suffix('.tmp')
+    with open(filepath_tmp, 'w') as f:
+        json.dump(catalogue_str, f, indent=1)
+    filepath_tmp.replace(filepath)
+
+def ajouter_intervalle(intervalles, deb, fin, pas):
+    '''Ajout d'un intervalle couvert et fusion des intervalles contigus.'''
+    fusion = []
+    for deb_i, fin_i in sorted(intervalles + [(deb, fin)]):
+        if (len(fusion) > 0) and (deb_i <= fusion[-1][1] + pas):
+            fusion[-1] = (fusion[-1][0], max(fusion[-1][1], fin_i))
+        else:
+            fusion.append((deb_i, fin_i))
+
+    return fusion
+
+def periodes_manquantes(intervalles, deb, fin, pas):
+    '''Sous-périodes annuelles de [deb, fin] non couvertes par les intervalles.'''
+    manques = []
+    debut_manque = deb
+    for deb_i, fin_i in sorted(intervalles):
+        if (fin_i < debut_manque) or (deb_i > fin):
+            continue
+        if deb_i > debut_manque:
+            manques.append((debut_manque, deb_i - pas))
+        debut_manque = max(debut_manque, fin_i + pas)
+    if debut_manque <= fin:
+        manques.append((debut_manque, fin))
+
+    # Découpage par année calendaire comme pour les commandes DPClim
+    periodes = []
+    for deb_m, fin_m in manques:
+        while deb_m <= fin_m:
+            fin_annee = pd.Timestamp(
+                year=deb_m.year + 1, month=1, day=1, tz=deb_m.tz) - pas
+            periodes.append((deb_m, min(fin_m, fin_annee)))
+            deb_m = fin_annee + pas
+
+    return periodes
+
+def periodes_a_commander(catalogue, id_stations, deb, fin, pas):
+    '''Regroupement par période des stations à commander.'''
+    commandes = {}
+    for id_station in id_stations:
+        intervalles = catalogue.get(str(id_station), [])
+        for periode in periodes_manquantes(intervalles, deb, fin, pas):
+            commandes.setdefault(periode, []).append(id_station)
+
+    return commandes
+
+def get_str_date_api(date):
+    return date.isoformat().replace("+00:00", "Z")
+
+def get_periode(date_deb_periode, date_fin_periode):
+    '''Dates de début et de fin localisées dans le fuseau de l'API.'''
+    deb = pd.Timestamp(date_deb_periode)
+    fin = pd.Timestamp(date_fin_periode)
+    if deb.tz is None:
+        deb, fin = deb.tz_localize(meteofrance.TZ), fin.tz_localize(meteofrance.TZ)
+
+    return deb, fin
+
+def importer_fichiers_annuels(
+    client, df_liste_stations, ref_station_name, deb, fin, frequence=None):
+    '''Import dans l'archive des fichiers annuels écrits par les notebooks
+    avant l'archive (`meteofrance.get_filepath_donnee_periode`), pour les
+    années de [deb, fin] que le catalogue ne couvre pas encore.
+
+    Ces fichiers ne contiennent que les variables alors demandées.'''
+    filepath_archive = get_filepath_archive(client, frequence=frequence)
+    filepath_catalogue = get_filepath_catalogue(client, frequence=frequence)
+    pas = PAS_TEMPS[frequence]
+    catalogue = lire_catalogue(filepath_catalogue)
+
+    # Années découpées comme dans les notebooks
+    idx_dates_deb = pd.date_range(start=deb, end=fin, freq='YS-JAN')
+    idx_dates_fin = pd.date_range(
+        start=deb, end=fin, freq='YE-DEC') + pd.Timedelta(days=1) - pas
+    for deb_an, fin_an in zip(idx_dates_deb, idx_dates_fin):
+        if len(periodes_a_commander(catalogue, df_liste_stations.index,
+                                    deb_an, fin_an, pas)) == 0:
+            continue
+        filepath = meteofrance.get_filepath_donnee_periode(
+            client, ref_station_name, df_liste_stations,
+            get_str_date_api(deb_an), get_str_date_api(fin_an),
+            frequence=frequence)
+        if not (filepath.exists() or
+                filepath.with_suffix(stockage.SUFFIXES['csv']).exists()):
+            continue
+        df_an = stockage.lire(
+            filepath, parse_dates=[client.time_label],
+            index_col=[client.id_station_donnee_label, client.time_label])
+        stockage.ecrire(df_an, filepath_archive, ajout=True)
+
+        for id_station in df_an.index.unique(client.id_station_donnee_label):
+            catalogue[str(id_station)] = ajouter_intervalle(
+                catalogue.get(str(id_station), []), deb_an, fin_an, pas)
+        ecrire_catalogue(catalogue, filepath_catalogue)
+
+def compiler_archive_des_stations_periode(
+    client, df_liste_stations, date_deb_periode, date_fin_periode,
+    frequence=None, telecharger=True, ref_station_name=None, **kwargs):
+    '''Donnée des stations pour la période à partir de l'archive.
+
+    Seules les stations-périodes absentes du catalogue sont commandées
+    (si `telecharger` est vrai) puis fusionnées dans l'archive. Si
+    `ref_station_name` est donné, les fichiers annuels déjà écrits pour
+    cette référence sont d'abord importés dans l'archive.
+    Les arguments supplémentaires sont passés à
+    `meteofrance.compiler_telechargement_des_stations_periode`.'''
+    filepath_archive = get_filepath_archive(client, frequence=frequence)
+    filepath_catalogue = get_filepath_catalogue(client, frequence=frequence)
+    pas = PAS_TEMPS[frequence]
+    deb, fin = get_periode(date_deb_periode, date_fin_periode)
+
+    if ref_station_name is not None:
+        importer_fichiers_annuels(
+            client, df_liste_stations, ref_station_name, deb, fin,
+            frequence=frequence)
+
+    if telecharger:
+        catalogue = lire_catalogue(filepath_catalogue)
+        commandes = periodes_a_commander(
+            catalogue, df_liste_stations.index, deb, fin, pas)
+        for (deb_c, fin_c), id_stations in commandes.items():
+            df_commande = meteofrance.compiler_telechargement_des_stations_periode(
+                client, df_liste_stations.loc[id_stations],
+                get_str_date_api(deb_c), get_str_date_api(fin_c),
+                frequence=frequence, **kwargs)
+            stockage.ecrire(df_commande, filepath_archive, ajout=True)
+
+            # Le catalogue est mis à jour après chaque période téléchargée
+            # pour ne pas perdre les périodes déjà archivées en cas d'erreur
+            for id_station in id_stations:
+                catalogue[str(id_station)] = ajouter_intervalle(
+                    catalogue.get(str(id_station), []), deb_c, fin_c, pas)
+            ecrire_catalogue(catalogue, filepath_catalogue)
+
+    # Lecture des seules partitions des stations et des années demandées
+    filtres = [
+        (client.id_station_donnee_label, 'in', df_liste_stations.index.tolist()),
+        (stockage.COLONNE_ANNEE, 'in', list(range(deb.year, fin.year + 1)))]
+    df = stockage.lire(
+        filepath_archive, parse_dates=[client.time_label],
+        index_col=[client.id_station_donnee_label, client.time_label],
+        filtres=filtres)
+    time = df.index.get_level_values(client.time_label)
+
+    return df[(time >= deb) & (time <= fin)]
+
+def compiler_cube_des_stations_periode(
+    client, df_liste_stations, date_deb_periode, date_fin_periode,
+    frequence=None, variables=None, telecharger=True, reconstruire=False,
+    **kwargs):
+    '''Cube sur disque de la donnée des stations pour la période.
+
+    Le cube existant est réutilisé s'il couvre les stations, les `variables`
+    et la période, entièrement remplie (sauf si `reconstruire` est vrai).
+    Sinon, il est rempli année par année à partir de l'archive, sans
+    charger toute la période en mémoire. Sans `variables`, ce sont les
+    variables numériques de la première année lue.
+    Les arguments supplémentaires sont passés à
+    `compiler_archive_des_stations_periode`.'''
+    dossier = get_dossier_cube(client, frequence=frequence)
+    pas = PAS_TEMPS[frequence]
+    deb, fin = get_periode(date_deb_periode, date_fin_periode)
+
+    if (not reconstruire) and (dossier / cube_stations.NOM_INDEX).exists():
+        cube = cube_stations.CubeStations(dossier)
+        if cube.couvre(df_liste_stations.index,
+                       [] if variables is None else variables, deb, fin):
+            return cube
+
+    cube = None
+    deb_annee = deb
+    while deb_annee <= fin:
+        fin_annee = min(fin, pd.Timestamp(
+            year=deb_annee.year + 1, month=1, day=1, tz=deb_annee.tz) - pas)
+        df_annee = compiler_archive_des_stations_periode(
+            client, df_liste_stations, deb_annee, fin_annee,
+            frequence=frequence, telecharger=telecharger, **kwargs)
+        if cube is None:
+            if variables is None:
+                variables = df_annee.select_dtypes('number').columns
+            cube = cube_stations.CubeStations.creer(
+                dossier, df_liste_stations.index, variables, deb, fin, pas,
+                noms_index=[client.id_station_donnee_label, client.time_label])
+        cube.ecrire(df_annee)
+
+        # Une année interrompue n'est pas marquée et le cube sera reconstruit
+        cube.marquer_remplie(deb_annee, fin_annee)
+        deb_annee = fin_annee + pas
+
+    return cube
@@ -0,0 +1,252 @@
+'''Mesures de performance des calculs et des téléchargements.
+
+Utilisation : `python benchmarks.py [nom_du_benchmark ...]`
+(tous les benchmarks sont exécutés si aucun nom n'est donné).
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+import etp
+import geo
+import meteofrance
+
+
+class MockDPClimHandler(BaseHTTPRequestHandler):
+    '''Imitation locale des points d'accès de commande de l'API DPClim.'''
+    # Latence de chaque requête (s)
+    latence = 0.2
+    # Durée de préparation d'une commande (s)
+    delai_preparation = 1.
+    # Commandes passées : identifiant -> (heure de commande, paramètres)
+    commandes = {}
+    compteur = itertools.count(1)
+    verrou = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _repondre(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latence)
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if '/commande-station/' in url.path:
+            with self.verrou:
+                id_cmde = str(next(self.compteur))
+                self.commandes[id_cmde] = (time.time(), params)
+            body = json.dumps({'elaboreProduitAvecDemandeResponse': {
+                'return': id_cmde}}).encode()
+            self._repondre(202, body, 'application/json')
+        elif url.path.endswith('/commande/fichier'):
+            heure_commande, params_cmde = self.commandes[params['id-cmde']]
+            if time.time() - heure_commande < self.delai_preparation:
+                self._repondre(204, b'', 'application/json')
+            else:
+                self._repondre(201, self._csv_station(params_cmde).encode(),
+                               'text/csv')
+        else:
+            self._repondre(404, b'{}', 'application/json')
+
+    @staticmethod
+    def _csv_station(params):
+        dates = pd.date_range(params['date-deb-periode'],
+                              params['date-fin-periode'], freq='h')
+        valeurs = np.random.default_rng(0).random((len(dates), 5)) * 10
+        df = pd.DataFrame(valeurs, columns=['GLO', 'T', 'U', 'FF', 'RR1'])
+        df.insert(0, 'DATE', dates.strftime('%Y%m%d%H'))
+        df.insert(0, 'POSTE', params['id-station'])
+
+        return df.to_csv(sep=';', decimal=',', index=False,
+                         float_format='%.1f')
+
+
+def _demarrer_mock_dpclim():
+    '''Démarrage du serveur imitant l'API DPClim et redirection des requêtes.'''
+    serveur = ThreadingHTTPServer(('127.0.0.1', 0), MockDPClimHandler)
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    meteofrance.HOST = f"http://127.0.0.1:{serveur.server_address[1]}"
+
+    return serveur
+
+
+def _client_mock(api='DPClim'):
+    client = meteofrance.Client(api, requetes_par_minute=None, cache=False)
+    client.session.headers.update({'Authorization': 'Bearer mock'})
+
+    return client
+
+
+def _telechargement_sequentiel(
+    client, df_liste_stations, date_deb_periode, date_fin_periode,
+    frequence=None, read_csv_kwargs={}, retry_interval=5):
+    '''Référence : commandes puis téléchargements l'un après l'autre.'''
+    id_commandes = {
+        id_station: meteofrance.commander_station_periode(
+            client, id_station, date_deb_periode, date_fin_periode,
+            frequence=frequence)
+        for id_station in df_liste_stations.index}
+    l_df = []
+    for id_cmde in id_commandes.values():
+        while True:
+            df_station = meteofrance.telecharger_commande(
+                client, id_cmde, read_csv_kwargs=read_csv_kwargs)
+            if df_station is not None:
+                break
+            time.sleep(retry_interval)
+        l_df.append(df_station)
+
+    return pd.concat(l_df)
+
+
+def benchmark_telechargement_des_stations_periode(
+    nombre_stations=32, retry_interval=0.1):
+    '''Téléchargement DPClim séquentiel contre simultané sur un mock local.'''
+    serveur = _demarrer_mock_dpclim()
+    client = _client_mock()
+    df_liste_stations = pd.DataFrame(
+        {client.station_name_label: [f"Station {i:d}"
+                                     for i in range(nombre_stations)]},
+        index=pd.Index(1001000 + np.arange(nombre_stations),
+                       name=client.id_station_label))
+    kwargs = dict(frequence='horaire', retry_interval=retry_interval,
+                  read_csv_kwargs={'date_format': "%Y%m%d%H"})
+    dates = ('2024-01-01T00:00:00Z', '2024-01-31T23:00:00Z')
+
+    print(f"Téléchargement de {nombre_stations:d} stations "
+          f"(latence {MockDPClimHandler.latence:.2f} s, "
+          f"préparation {MockDPClimHandler.delai_preparation:.2f} s)")
+    start_time = time.perf_counter()
+    _telechargement_sequentiel(client, df_liste_stations, *dates, **kwargs)
+    print(f"  séquentiel : {time.perf_counter() - start_time:.2f} s")
+
+    for max_workers in [1, 4, meteofrance.MAX_REQUETES_SIMULTANEES, 16]:
+        start_time = time.perf_counter()
+        meteofrance.compiler_telechargement_des_stations_periode(
+            client, df_liste_stations, *dates, max_workers=max_workers,
+            **kwargs)
+        print(f"  simultané ({max_workers:d} requêtes) : "
+              f"{time.perf_counter() - start_time:.2f} s")
+
+    serveur.shutdown()
+
+
+def _mesurer(fonction, *args, **kwargs):
+    '''Durée (s) et pic de mémoire allouée (Mo) d'un appel.'''
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    resultat = fonction(*args, **kwargs)
+    duree = time.perf_counter() - start_time
+    pic = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.stop()
+
+    return resultat, duree, pic
+
+
+def _interpolation_unstack(df, s_dist_km):
+    '''Référence : interpolation par pivot des stations en DataFrames.'''
+    poids = 1. / s_dist_km**2
+    df_piv = df.unstack()
+    poids_piv = (df_piv + 1.e-6).mul(poids, axis='index') / (df_piv + 1.e-6)
+    df_ref = ((df_piv * poids_piv).sum(axis=0) / poids_piv.sum(axis=0)).unstack().transpose()
+
+    return df_ref
+
+
+def _donnee_stations_horaire(nombre_stations, annees, fraction_manquante=0.05):
+    '''Donnée horaire aléatoire indexée par (station, temps).'''
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2000-01-01', periods=annees * 365 * 24, freq='h',
+                         tz=meteofrance.TZ)
+    index = pd.MultiIndex.from_product(
+        [1001000 + np.arange(nombre_stations), time], names=['POSTE', 'DATE'])
+    valeurs = rng.random((len(index), 5)) * 10
+    valeurs[rng.random(valeurs.shape) < fraction_manquante] = np.nan
+    df = pd.DataFrame(valeurs, index=index,
+                      columns=['GLO', 'T', 'U', 'FF', 'RR1'])
+    s_dist_km = pd.Series(rng.integers(1, 50, nombre_stations).astype(float),
+                          index=df.index.levels[0])
+
+    return df, s_dist_km
+
+
+def benchmark_interpolation(nombre_stations=10, annees_arr=[1, 10]):
+    '''Interpolation par pivot contre interpolation NumPy en un passage.'''
+    for annees in annees_arr:
+        df, s_dist_km = _donnee_stations_horaire(nombre_stations, annees)
+        print(f"Interpolation de {nombre_stations:d} stations sur "
+              f"{annees:d} an(s) horaires ({len(df):d} lignes)")
+        df_ref, duree, pic = _mesurer(_interpolation_unstack, df, s_dist_km)
+        print(f"  pivot : {duree:.2f} s, {len(df) / duree:.2e} lignes/s, "
+              f"pic mémoire {pic:.0f} Mo")
+        df_ref_np, duree, pic = _mesurer(
+            geo.interpolation_inverse_distance_carre, df, s_dist_km)
+        print(f"  NumPy : {duree:.2f} s, {len(df) / duree:.2e} lignes/s, "
+              f"pic mémoire {pic:.0f} Mo")
+        ecart = np.nanmax(np.abs(df_ref.to_numpy() - df_ref_np.to_numpy()))
+        print(f"  écart maximal : {ecart:.1e}")
+
+
+def _meteo_horaire(annees, seed=0):
+    '''Météo horaire synthétique d'un site aux unités du calcul de l'ETP.'''
+    rng = np.random.default_rng(seed)
+    time = pd.date_range('1990-01-01', periods=annees * 365 * 24, freq='h',
+                         tz=meteofrance.TZ)
+    heure = time.hour.to_numpy()
+    df = pd.DataFrame({
+        'temperature_2m': (283. + 8. * np.sin(2 * np.pi * (heure - 9) / 24) +
+                           rng.normal(0., 1., len(time))),
+        'humidite_relative': rng.uniform(0.4, 0.95, len(time)),
+        'vitesse_vent_10m': rng.uniform(0., 8., len(time)),
+        'rayonnement_global': np.maximum(0., 2.5e6 * np.sin(
+            np.pi * (heure - 6) / 12)) * rng.uniform(0.3, 1., len(time))
+    }, index=time)
+
+    return df
+
+
+def benchmark_etp(annees_arr=[1, 10, 30], latitude=43.6, longitude=3.9,
+                  altitude=50.):
+    '''ETP par pvlib et pandas contre le noyau NumPy (et numba si disponible).'''
+    moteurs = etp.MOTEURS if etp.numba is not None else ['numpy']
+    for annees in annees_arr:
+        df = _meteo_horaire(annees)
+        print(f"ETP horaire sur {annees:d} an(s) ({len(df):d} heures)")
+        s_etp, duree, pic = _mesurer(
+            etp.calcul_etp, df, latitude, longitude, altitude)
+        print(f"  pvlib : {duree:.2f} s, pic mémoire {pic:.0f} Mo")
+        for moteur in moteurs:
+            # Premier appel hors mesure pour la compilation de numba
+            etp.calcul_etp_numpy(df.iloc[:24], latitude, longitude, altitude,
+                                 moteur=moteur)
+            s_etp_np, duree, pic = _mesurer(
+                etp.calcul_etp_numpy, df, latitude, longitude, altitude,
+                moteur=moteur)
+            ecart = np.nanmax(np.abs(s_etp.to_numpy() - s_etp_np.to_numpy()))
+            print(f"  {moteur} : {duree:.2f} s, pic mémoire {pic:.0f} Mo, "
+                  f"écart maximal {ecart:.1e} mm h-1")
+
+
+BENCHMARKS = {
+    'telechargement': benchmark_telechargement_des_stations_periode,
+    'interpolation': benchmark_interpolation,
+    'etp': benchmark_etp,
+}
+
+if __name__ == '__main__':
+    for nom in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[nom]()
@@ -2,14 +2,17 @@ import json
 import numpy as np
 import pandas as pd
 from pathlib import Path
+import threading
 
 
-# Coefficients culturaux (KC) par culture et par stade
-FILEPATH_KC = Path("coefficients_culturaux_ardepi.json")
+# Coefficients culturaux (KC) par culture et par stade,
+# à côté du module quel que soit le dossier de travail
+FILEPATH_KC = Path(__file__).parent / "coefficients_culturaux_ardepi.json"
 
-# Lecture des coefficients culturaux
-with open(FILEPATH_KC) as f:
-    KC = json.load(f)
+# Coefficients culturaux et table des cultures, chargés à la première utilisation
+_KC = None
+_TABLE_CULTURES = None
+_VERROU_KC = threading.Lock()
 
 # Réserve Utile (RU) par cm de terre fine (mm/cm de terre fine) en fonction de la texture du sol
 RU_PAR_CM_DE_TF = {
@@ -48,7 +51,67 @@ PROFONDEUR_ENRACINEMENT_TYPIQUE = {
     "Tomate": 30.
 }
 
-# Variables météorologiques utilisées pour le bilan hydrique
+def get_kc():
+    '''Coefficients culturaux par culture et par stade (lus une seule fois).'''
+    global _KC
+    with _VERROU_KC:
+        if _KC is None:
+            with open(FILEPATH_KC) as f:
+                _KC = json.load(f)
+        return _KC
+
+def __getattr__(name):
+    # `bilan.KC` reste disponible sans lire le fichier à l'import
+    if name == 'KC':
+        return get_kc()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class TableCultures(object):
+    '''Table compacte des paramètres des cultures et des textures.
+
+    Les textures et les couples (culture, stade) sont codés par des
+    entiers et leurs paramètres rangés dans des tableaux, de façon à
+    être rassemblés par indice dans les calculs vectorisés.
+    La profondeur d'enracinement des cultures inconnues vaut NaN.'''
+    def __init__(self, kc, profondeurs, ru_par_cm):
+        self.textures = pd.Index(list(ru_par_cm), name='texture')
+        self.ru_par_cm = np.array(list(ru_par_cm.values()))
+
+        self.couples = pd.MultiIndex.from_tuples(
+            [(culture, stade) for culture, kc_stades in kc.items()
+             for stade in kc_stades], names=['culture', 'stade'])
+        self.kc = np.array([kc[culture][stade]
+                            for culture, stade in self.couples])
+        self.profondeur = np.array([
+            profondeurs.get(culture, np.nan)
+            for culture in self.couples.get_level_values('culture')])
+
+    def codes_textures(self, textures):
+        codes = self.textures.get_indexer(textures)
+        if (codes < 0).any():
+            raise ValueError(f"Choix invalide: {list(pd.Index(textures)[codes < 0])}. "
+                             f"Les choix possibles sont: {list(self.textures)}")
+        return codes
+
+    def codes_couples(self, cultures_stades):
+        codes = self.couples.get_indexer(list(cultures_stades))
+        if (codes < 0).any():
+            invalides = [cultures_stades[i] for i in np.flatnonzero(codes < 0)]
+            raise ValueError(f"Choix invalide: {invalides}. "
+                             "Les choix possibles sont les couples de KC.")
+        return codes
+
+def get_table_cultures():
+    '''Table des cultures construite à la première utilisation.'''
+    global _TABLE_CULTURES
+    kc = get_kc()
+    with _VERROU_KC:
+        if _TABLE_CULTURES is None:
+            _TABLE_CULTURES = TableCultures(
+                kc, PROFONDEUR_ENRACINEMENT_TYPIQUE, RU_PAR_CM_DE_TF)
+        return _TABLE_CULTURES
+
+# Variables météorologiques utilisées pour le bilan hydrique
 # et leur méthode d'aggrégation journalière
 VARIABLES_CALCUL_BILAN = {
     'etp': 'sum',
@@ -75,10 +138,57 @@ def calcul_reserve_facilement_utilisable(ru_remplie, ru_vers_rfu):
     ''' Calcul de la RFU (mm).'''
     return ru_remplie * ru_vers_rfu
 
-def calcul_etm_culture(culture, stade, df_meteo):
-    ''' Calcul de l'évalotranspiration maximale de la culture (mm).'''
+def calcul_kc_calendrier(
+    culture, dates_semis, durees_stades, time,
+    interpolation=False, kc_hors_saison=0.):
+    ''' Série des KC d'une culture d'après son calendrier de stades.
+
+    Les stades de la culture se succèdent à partir de chaque date de semis
+    pour les durées `durees_stades` (jours, par stade ou dans l'ordre des
+    stades). Si `interpolation` est vrai, le KC varie linéairement entre
+    les milieux des stades. Hors saison, le KC vaut `kc_hors_saison`.'''
+    kc_stades = get_kc()[culture]
+    stades = list(kc_stades)
+    if isinstance(durees_stades, dict):
+        durees_stades = [durees_stades[stade] for stade in stades]
+    if len(durees_stades) != len(stades):
+        raise ValueError(f"Une durée est attendue pour chacun des stades: {stades}")
+    valeurs_kc = np.array([kc_stades[stade] for stade in stades])
+
+    # Jours de début des stades depuis le semis et fin de saison
+    bornes = np.concatenate([[0.], np.cumsum(durees_stades, dtype=float)])
+    centres = (bornes[:-1] + bornes[1:]) / 2
+
+    time = pd.DatetimeIndex(time)
+    if not pd.api.types.is_list_like(dates_semis):
+        dates_semis = [dates_semis]
+    dates_semis = pd.DatetimeIndex(dates_semis)
+    if (dates_semis.tz is None) and (time.tz is not None):
+        dates_semis = dates_semis.tz_localize(time.tz)
+
+    kc = np.full(len(time), float(kc_hors_saison))
+    for date_semis in dates_semis:
+        jours = ((time - date_semis) / pd.Timedelta(days=1)).to_numpy()
+        saison = (jours >= 0.) & (jours < bornes[-1])
+        if interpolation:
+            kc_saison = np.interp(jours, centres, valeurs_kc)
+        else:
+            stade = np.searchsorted(bornes, jours, side='right') - 1
+            kc_saison = valeurs_kc[np.clip(stade, 0, len(stades) - 1)]
+        kc = np.where(saison, kc_saison, kc)
+
+    return pd.Series(kc, index=time, name='kc')
+
+def calcul_etm_culture(culture, stade, df_meteo, kc=None):
+    ''' Calcul de l'évalotranspiration maximale de la culture (mm).
+
+    Si une série `kc` (par exemple de `calcul_kc_calendrier`) est donnée,
+    elle remplace le KC du stade.'''
     # KC de la culture pour ce stade
-    kc_culture = KC[culture][stade]
+    if kc is not None:
+        kc_culture = kc.to_numpy() if isinstance(kc, pd.Series) else kc
+    else:
+        kc_culture = get_kc()[culture][stade]
 
     etm_culture = kc_culture * df_meteo['etp']
 
@@ -90,9 +200,11 @@ def calcul_bilan(
     culture, stade,
     fraction_ru_remplie, ru_vers_rfu,
     seuil_irrigation, hauteur_vers_duree_irrigation,
-    rfu_cible=None
+    rfu_cible=None, kc=None
 ):
-    ''' Calcul du besoin en irrigation (mm).'''
+    ''' Calcul du besoin en irrigation (mm).
+
+    Une série `kc` alignée sur `df_meteo` remplace le KC du stade.'''
     if isinstance(df_meteo, pd.Series):
         df = pd.Series(dtype=float)
     else:
@@ -113,7 +225,7 @@ def calcul_bilan(
     
     df['precipitation'] = df_meteo['precipitation']
     
-    df['etm_culture'] = -calcul_etm_culture(culture, stade, df_meteo)
+    df['etm_culture'] = -calcul_etm_culture(culture, stade, df_meteo, kc=kc)
 
     if rfu_cible is None:
         rfu_cible = df['rfu']
@@ -128,4 +240,170 @@ def calcul_bilan(
     df['duree_irrigation'] = hauteur_vers_duree_irrigation * np.where(
         df['irrigation'], df['besoin_irrigation'], 0)
 
-    return df
\ No newline at end of file
+    return df
+
+# Variables enregistrées par la simulation du réservoir
+# (la hauteur d'irrigation en mm, 'irrigation' étant booléen comme
+# dans `calcul_bilan`)
+VARIABLES_SIMULATION = [
+    'reserve', 'rfu', 'besoin_irrigation', 'hauteur_irrigation', 'drainage']
+
+def simulation_reservoir(
+    precipitation, etm_culture, ru, rfu,
+    seuil_irrigation, fraction_ru_remplie=1., rfu_cible=None,
+    sorties=VARIABLES_SIMULATION, dtype=np.float32):
+    ''' Simulation journalière du réservoir du sol (mm).
+
+    La réserve est reportée d'un jour à l'autre, bornée par 0 et la RU,
+    l'excès au-delà de la RU étant drainé. La RFU disponible est la part
+    de la réserve au-delà de RU - RFU. Lorsque le besoin pour ramener
+    la RFU disponible à `rfu_cible` (par défaut la RFU) dépasse le seuil,
+    ce besoin est irrigué en fin de journée.
+
+    Les précipitations et l'ETM de la culture (positives) ont le temps
+    comme dernier axe, les autres paramètres étant diffusés sur les autres
+    axes (parcelles, scénarios). Renvoie un dictionnaire des tableaux
+    des variables `sorties`.'''
+    # Temps en premier axe pour des écritures contiguës à chaque pas
+    precipitation = np.moveaxis(np.asarray(precipitation, dtype=float), -1, 0)
+    etm_culture = np.moveaxis(np.asarray(etm_culture, dtype=float), -1, 0)
+    forme = np.broadcast_shapes(
+        precipitation.shape[1:], etm_culture.shape[1:], np.shape(ru),
+        np.shape(rfu), np.shape(seuil_irrigation))
+    ru = np.broadcast_to(ru, forme)
+    rfu = np.broadcast_to(rfu, forme)
+    rfu_cible = rfu if rfu_cible is None else np.broadcast_to(rfu_cible, forme)
+    reserve_difficile = ru - rfu
+
+    nombre_jours = precipitation.shape[0]
+    resultats = {variable: np.empty((nombre_jours,) + forme, dtype=dtype)
+                 for variable in sorties}
+    reserve = ru * fraction_ru_remplie
+    for jour in range(nombre_jours):
+        # Apports et prélèvements du jour
+        reserve = reserve + precipitation[jour] - etm_culture[jour]
+
+        # Drainage au-delà de la RU et réserve vide
+        drainage = np.maximum(reserve - ru, 0.)
+        reserve = np.clip(reserve, 0., ru)
+
+        # Irrigation au-delà du seuil pour revenir à la RFU cible
+        rfu_disponible = np.maximum(reserve - reserve_difficile, 0.)
+        besoin_irrigation = rfu_cible - rfu_disponible
+        hauteur_irrigation = np.where(
+            besoin_irrigation > seuil_irrigation, besoin_irrigation, 0.)
+        reserve = np.minimum(reserve + hauteur_irrigation, ru)
+
+        etat = {'reserve': reserve, 'rfu': rfu_disponible,
+                'besoin_irrigation': besoin_irrigation,
+                'hauteur_irrigation': hauteur_irrigation, 'drainage': drainage}
+        for variable, resultat in resultats.items():
+            resultat[jour] = etat[variable]
+
+    return {variable: np.moveaxis(resultat, 0, -1)
+            for variable, resultat in resultats.items()}
+
+def simulation_bilan(
+    df_meteo,
+    texture, fraction_cailloux,
+    culture, stade,
+    fraction_ru_remplie, ru_vers_rfu,
+    seuil_irrigation, hauteur_vers_duree_irrigation,
+    rfu_cible=None, kc=None):
+    ''' Simulation journalière du bilan d'une parcelle sur une série
+    météorologique quotidienne (DataFrame indexé par date).
+
+    Comme pour `calcul_bilan`, 'irrigation' indique si la parcelle est
+    irriguée, la hauteur irriguée (mm) étant 'hauteur_irrigation'.
+    Une série `kc` alignée sur `df_meteo` remplace le KC du stade.'''
+    _, _, ru, _ = calcul_reserve_utile(
+        texture, fraction_cailloux, culture, fraction_ru_remplie)
+    rfu = calcul_reserve_facilement_utilisable(ru, ru_vers_rfu)
+    etm_culture = calcul_etm_culture(culture, stade, df_meteo, kc=kc)
+
+    resultats = simulation_reservoir(
+        df_meteo['precipitation'].to_numpy(), etm_culture.to_numpy(),
+        ru, rfu, seuil_irrigation, fraction_ru_remplie=fraction_ru_remplie,
+        rfu_cible=rfu_cible, dtype=float)
+    df = pd.DataFrame(resultats, index=df_meteo.index)
+    df['irrigation'] = df['hauteur_irrigation'] > 0.
+    df['duree_irrigation'] = (hauteur_vers_duree_irrigation *
+                              df['hauteur_irrigation'])
+
+    return df
+
+# Variables disponibles pour le balayage des paramètres du bilan
+VARIABLES_BALAYAGE = ['besoin_irrigation', 'duree_irrigation']
+
+def balayage_bilan(
+    df_meteo,
+    textures=None, fractions_cailloux=(0.,),
+    cultures_stades=None, ru_vers_rfu=(2. / 3,),
+    fraction_ru_remplie=1., seuil_irrigation=0.,
+    hauteur_vers_duree_irrigation=1., rfu_cible=None,
+    variable='besoin_irrigation'):
+    ''' Calcul du bilan pour toutes les combinaisons des grilles de paramètres.
+
+    Par défaut, toutes les textures et tous les couples (culture, stade)
+    des cultures de profondeur d'enracinement connue sont balayés.
+    Le calcul est celui de `calcul_bilan`, effectué en un seul passage
+    NumPy sur les axes (texture, fraction_cailloux, culture/stade,
+    ru_vers_rfu, temps). Renvoie un DataFrame de la variable indexé par
+    combinaison, avec le temps en colonnes.'''
+    if variable not in VARIABLES_BALAYAGE:
+        raise ValueError(f"Choix invalide: {variable}. "
+                         f"Les choix possibles sont: {VARIABLES_BALAYAGE}")
+    if isinstance(df_meteo, pd.Series):
+        df_meteo = df_meteo.to_frame().transpose()
+    table = get_table_cultures()
+    if textures is None:
+        codes_textures = np.arange(len(table.textures))
+    else:
+        codes_textures = table.codes_textures(textures)
+    if cultures_stades is None:
+        codes_couples = np.flatnonzero(~np.isnan(table.profondeur))
+    else:
+        codes_couples = table.codes_couples(cultures_stades)
+
+    # Paramètres par axe rassemblés par code, diffusés sur
+    # (texture, cailloux, culture/stade, rfu)
+    ru_par_cm = table.ru_par_cm[codes_textures]
+    terre_fine = 1. - np.asarray(fractions_cailloux, dtype=float)
+    profondeur = table.profondeur[codes_couples]
+    kc = table.kc[codes_couples]
+    ru_vers_rfu = np.asarray(ru_vers_rfu, dtype=float)
+
+    rfu = (ru_par_cm[:, None, None, None] * terre_fine[None, :, None, None] *
+           profondeur[None, None, :, None] * ru_vers_rfu[None, None, None, :])
+    if rfu_cible is None:
+        rfu_cible = rfu
+
+    # Besoin de calcul_bilan : rfu_cible - (RFU remplie + P - ETM)
+    etp = df_meteo['etp'].to_numpy(dtype=float)
+    precipitation = df_meteo['precipitation'].to_numpy(dtype=float)
+    besoin_irrigation = (
+        (rfu_cible - rfu * fraction_ru_remplie)[..., None] - precipitation +
+        kc[None, None, :, None, None] * etp)
+
+    if variable == 'duree_irrigation':
+        valeurs = hauteur_vers_duree_irrigation * np.where(
+            besoin_irrigation > seuil_irrigation, besoin_irrigation, 0.)
+    else:
+        valeurs = besoin_irrigation
+
+    # Étiquettes des combinaisons dans l'ordre des axes
+    formes = (len(codes_textures), len(terre_fine), len(codes_couples),
+              len(ru_vers_rfu))
+    positions = np.indices(formes).reshape(len(formes), -1)
+    couples = table.couples[codes_couples]
+    index = pd.MultiIndex.from_arrays([
+        table.textures[codes_textures][positions[0]],
+        np.asarray(fractions_cailloux, dtype=float)[positions[1]],
+        couples.get_level_values('culture')[positions[2]],
+        couples.get_level_values('stade')[positions[2]],
+        ru_vers_rfu[positions[3]]],
+        names=['texture', 'fraction_cailloux', 'culture', 'stade',
+               'ru_vers_rfu'])
+
+    return pd.DataFrame(valeurs.reshape(-1, len(df_meteo)), index=index,
+                        columns=df_meteo.index)
@@ -0,0 +1,394 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import requests
+from requests.structures import CaseInsensitiveDict
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Pas de verrou de fichier entre processus hors POSIX (Windows)
+    fcntl = None
+
+# Durées de vie (s) des réponses en cache par section de l'API
+# (None pour une conservation illimitée, sections absentes non mises en cache)
+DUREES_VIE = {
+    'liste-stations': 3 * 24 * 3600.,
+    'paquet': 3600.,
+    'station': 3600.,
+    'commande-station': 24 * 3600.,
+    'commande': None
+}
+
+# Sections dont les réponses expirent à la fin de la période de leur durée
+# de vie en cours (paquets horaires valables jusqu'à l'heure suivante)
+SECTIONS_PERIODIQUES = ('paquet',)
+
+# Taille maximale du cache sur disque (octets)
+TAILLE_MAX = 1024**3
+
+# Nom du fichier d'index du cache
+NOM_INDEX = 'index.json'
+
+# Nom du fichier verrouillé pendant la mise à jour de l'index
+NOM_VERROU_INDEX = 'index.lock'
+
+# Taille (octets) des blocs écrits dans le cache
+TAILLE_BLOC = 1024**2
+
+# Nombre maximal d'objets du cache en mémoire
+NOMBRE_MAX_OBJETS = 256
+
+class FichierFlux(io.FileIO):
+    '''Fichier du cache lu en flux comme corps d'une réponse,
+    fermé dès que sa lecture est terminée.'''
+    def readinto(self, b):
+        if self.closed:
+            return 0
+        n = super().readinto(b)
+        if n == 0:
+            self.close()
+        return n
+
+    def read(self, size=-1):
+        if self.closed:
+            return b''
+        bloc = super().read(size)
+        if len(bloc) == 0:
+            self.close()
+        return bloc
+
+class CacheReponses(object):
+    '''Cache sur disque des réponses de l'API adressées par leur demande.
+
+    Chaque réponse est rangée dans un fichier nommé d'après l'empreinte
+    de la demande (API, section, fréquence et paramètres). Les entrées
+    périmées sont ignorées et les moins récemment lues sont évincées
+    lorsque la taille du cache dépasse `taille_max`.
+
+    Les dates de lecture ne sont enregistrées qu'à l'écriture suivante.
+    L'index est alors fusionné avec celui sur disque, sous verrou de
+    fichier, pour que plusieurs processus puissent partager le dossier.'''
+    def __init__(self, dossier, taille_max=TAILLE_MAX, durees_vie=DUREES_VIE):
+        self.dossier = Path(dossier)
+        self.taille_max = taille_max
+        self.durees_vie = durees_vie
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        # Entrées supprimées par ce processus, à retirer de l'index sur disque
+        self._supprimees = set()
+        self._verrou = threading.RLock()
+        self._verrous_demandes = {}
+
+    @staticmethod
+    def cle(api, section, params=None, frequence=None):
+        '''Empreinte d'une demande.'''
+        params = {str(k): str(v) for k, v in (params or {}).items()}
+        demande = json.dumps([api, section, frequence, params], sort_keys=True)
+
+        return hashlib.sha256(demande.encode()).hexdigest()
+
+    @property
+    def index(self):
+        with self._verrou:
+            if self._index is None:
+                self._index = self._lire_index()
+            return self._index
+
+    def _lire_index(self):
+        filepath = self.dossier / NOM_INDEX
+        if not filepath.exists():
+            return {'entrees': {}, 'alias': {}}
+        with open(filepath) as f:
+            return json.load(f)
+
+    @contextmanager
+    def _verrou_fichier(self):
+        '''Exclusion des autres processus pendant la mise à jour de l'index.'''
+        self.dossier.mkdir(parents=True, exist_ok=True)
+        with open(self.dossier / NOM_VERROU_INDEX, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sauvegarder_index(self, evincer=False):
+        '''Fusion de l'index avec celui sur disque puis écriture atomique.
+
+        Pour une entrée connue des deux, la plus récemment lue ou écrite
+        est conservée. Les entrées supprimées par ce processus, ou dont le
+        fichier a été supprimé par un autre, sont retirées.'''
+        with self._verrou_fichier():
+            index_disque = self._lire_index()
+            entrees = index_disque['entrees']
+            for cle, entree in self.index['entrees'].items():
+                if cle in entrees:
+                    if entrees[cle]['acces'] <= entree['acces']:
+                        entrees[cle] = entree
+                elif (self.dossier / cle).exists():
+                    entrees[cle] = entree
+            alias = index_disque['alias']
+            alias.update(self.index['alias'])
+            for cle in self._supprimees:
+                entrees.pop(cle, None)
+            self._supprimees.clear()
+            self._index = {
+                'entrees': entrees,
+                'alias': {cle_alias: cle for cle_alias, cle in alias.items()
+                          if cle in entrees}}
+            if evincer:
+                self._evincer()
+
+            filepath = self.dossier / NOM_INDEX
+            filepath_tmp = self.dossier / f"{NOM_INDEX}.{os.getpid()}.tmp"
+            with open(filepath_tmp, 'w') as f:
+                json.dump(self._index, f)
+            filepath_tmp.replace(filepath)
+
+    @contextmanager
+    def verrou_demande(self, cle):
+        '''Exclusion des demandes simultanées d'une même clé : la première
+        est envoyée et les suivantes attendent puis lisent le cache.'''
+        with self._verrou:
+            verrou, nombre = self._verrous_demandes.get(cle, (threading.Lock(), 0))
+            self._verrous_demandes[cle] = (verrou, nombre + 1)
+        try:
+            with verrou:
+                yield
+        finally:
+            with self._verrou:
+                verrou, nombre = self._verrous_demandes[cle]
+                if nombre == 1:
+                    del self._verrous_demandes[cle]
+                else:
+                    self._verrous_demandes[cle] = (verrou, nombre - 1)
+
+    def associer(self, cle_alias, cle):
+        '''Lecture et écriture des réponses de `cle_alias` sous `cle`.'''
+        with self._verrou:
+            self.index['alias'][cle_alias] = cle
+            self._sauvegarder_index()
+
+    def lire(self, cle, flux=False):
+        '''Réponse en cache pour cette clé, None si absente ou périmée.
+
+        Si `flux` est vrai, le corps de la réponse n'est pas chargé
+        mais lu depuis le fichier du cache au fur et à mesure.'''
+        with self._verrou:
+            cle = self.index['alias'].get(cle, cle)
+            entree = self.index['entrees'].get(cle)
+            if ((entree is None) or
+                ((entree['expiration'] is not None) and
+                 (time.time() > entree['expiration']))):
+                self.misses += 1
+                return None
+
+            try:
+                if flux:
+                    fichier = FichierFlux(self.dossier / cle)
+                else:
+                    contenu = (self.dossier / cle).read_bytes()
+            except FileNotFoundError:
+                del self.index['entrees'][cle]
+                self._supprimees.add(cle)
+                self.misses += 1
+                return None
+
+            # Enregistrée dans l'index à la prochaine écriture
+            entree['acces'] = time.time()
+            self.hits += 1
+
+        response = requests.Response()
+        response.status_code = entree['status_code']
+        response.headers = CaseInsensitiveDict(entree['headers'])
+        response.encoding = entree['encoding']
+        response.url = entree['url']
+        if flux:
+            response.raw = fichier
+            response._content = False
+            response._content_consumed = False
+        else:
+            response._content = contenu
+
+        return response
+
+    def ecrire(self, cle, section, response):
+        '''Mise en cache d'une réponse non vide selon la durée de vie de sa section.
+
+        Les réponses des sections périodiques expirent à la fin de la
+        période en cours (l'heure pour les paquets) plutôt qu'une durée
+        de vie après leur écriture.
+
+        Le corps est copié par blocs dans un fichier temporaire, sans
+        bloquer les autres écritures. Si la réponse est lue en flux, son
+        corps est ensuite relu depuis le fichier du cache, fermé à la fin
+        de la lecture.'''
+        if (section not in self.durees_vie) or (not response.ok):
+            return
+
+        duree_vie = self.durees_vie[section]
+        with self._verrou:
+            cle = self.index['alias'].get(cle, cle)
+        self.dossier.mkdir(parents=True, exist_ok=True)
+        filepath_tmp = self.dossier / f"{cle}.{os.getpid()}.{threading.get_ident()}.tmp"
+        en_flux = not response._content_consumed
+        taille = 0
+        try:
+            with open(filepath_tmp, 'wb') as f:
+                for bloc in response.iter_content(chunk_size=TAILLE_BLOC):
+                    taille += f.write(bloc)
+        except BaseException:
+            filepath_tmp.unlink(missing_ok=True)
+            raise
+        finally:
+            if en_flux:
+                response.close()
+        if taille == 0:
+            filepath_tmp.unlink()
+            return
+
+        maintenant = time.time()
+        if duree_vie is None:
+            expiration = None
+        elif section in SECTIONS_PERIODIQUES:
+            expiration = (maintenant // duree_vie + 1) * duree_vie
+        else:
+            expiration = maintenant + duree_vie
+        with self._verrou:
+            filepath_tmp.replace(self.dossier / cle)
+            if en_flux:
+                response.raw = FichierFlux(self.dossier / cle)
+                response._content_consumed = False
+            self.index['entrees'][cle] = {
+                'section': section,
+                'status_code': response.status_code,
+                'headers': dict(response.headers),
+                'encoding': response.encoding,
+                'url': response.url,
+                'taille': taille,
+                'acces': maintenant,
+                'expiration': expiration
+            }
+            self._sauvegarder_index(evincer=True)
+
+    def _evincer(self):
+        '''Éviction des entrées les moins récemment lues au-delà de la taille maximale.'''
+        entrees = self.index['entrees']
+        taille = sum(entree['taille'] for entree in entrees.values())
+        for cle in sorted(entrees, key=lambda cle: entrees[cle]['acces']):
+            if taille <= self.taille_max:
+                break
+            taille -= entrees.pop(cle)['taille']
+            (self.dossier / cle).unlink(missing_ok=True)
+            self.index['alias'] = {
+                cle_alias: cle_cible
+                for cle_alias, cle_cible in self.index['alias'].items()
+                if cle_cible != cle}
+
+    def vider(self):
+        '''Suppression de toutes les entrées du cache.'''
+        with self._verrou:
+            with self._verrou_fichier():
+                cles = (set(self._lire_index()['entrees']) |
+                        set(self.index['entrees']))
+            for cle in cles:
+                (self.dossier / cle).unlink(missing_ok=True)
+            self._index = {'entrees': {}, 'alias': {}}
+            self._supprimees = cles
+            self._sauvegarder_index()
+
+    def statistiques(self):
+        '''Nombre de lectures réussies et manquées, d'entrées et taille du cache.'''
+        with self._verrou:
+            entrees = self.index['entrees']
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entrees': len(entrees),
+                'taille': sum(entree['taille'] for entree in entrees.values())
+            }
+
+class CacheMemoire(object):
+    '''Cache en mémoire d'objets (DataFrames lus...) partagé entre threads.
+
+    Les calculs simultanés d'une même clé sont regroupés : le premier
+    appel calcule l'objet et les suivants attendent son résultat. Les
+    objets sont partagés et ne doivent pas être modifiés sur place.'''
+    def __init__(self, nombre_max=NOMBRE_MAX_OBJETS):
+        self.nombre_max = nombre_max
+        self.hits = 0
+        self.misses = 0
+        self.regroupements = 0
+        # Clé -> (expiration, objet), de la moins à la plus récemment lue
+        self._objets = OrderedDict()
+        # Clé -> Future des calculs en cours
+        self._en_cours = {}
+        self._verrou = threading.Lock()
+
+    def obtenir(self, cle, fonction, *args, duree_vie=None, **kwargs):
+        '''Objet en cache pour cette clé, sinon calculé par
+        `fonction(*args, **kwargs)` et conservé `duree_vie` secondes
+        (sans limite si None).'''
+        with self._verrou:
+            objet = self._objets.get(cle)
+            if ((objet is not None) and
+                ((objet[0] is None) or (time.time() <= objet[0]))):
+                self._objets.move_to_end(cle)
+                self.hits += 1
+                return objet[1]
+            future = self._en_cours.get(cle)
+            if future is None:
+                future = self._en_cours[cle] = Future()
+                calcul = True
+                self.misses += 1
+            else:
+                calcul = False
+                self.regroupements += 1
+
+        if not calcul:
+            return future.result()
+
+        try:
+            valeur = fonction(*args, **kwargs)
+        except BaseException as exc:
+            with self._verrou:
+                del self._en_cours[cle]
+            future.set_exception(exc)
+            raise
+        with self._verrou:
+            expiration = (None if duree_vie is None else
+                          time.time() + duree_vie)
+            self._objets[cle] = (expiration, valeur)
+            self._objets.move_to_end(cle)
+            while len(self._objets) > self.nombre_max:
+                self._objets.popitem(last=False)
+            del self._en_cours[cle]
+        future.set_result(valeur)
+
+        return valeur
+
+    def vider(self):
+        '''Suppression de tous les objets du cache.'''
+        with self._verrou:
+            self._objets.clear()
+
+    def statistiques(self):
+        '''Nombre de lectures réussies, manquées et regroupées, et d'objets.'''
+        with self._verrou:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'regroupements': self.regroupements,
+                'objets': len(self._objets)
+            }
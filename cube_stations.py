@@ -0,0 +1,204 @@
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import geo
+
+# Noms des fichiers de la donnée et de l'index dans le dossier d'un cube
+NOM_DONNEE = 'donnee.npy'
+NOM_INDEX = 'index.json'
+
+# Type des valeurs stockées dans le cube
+DTYPE = np.float32
+
+# Nombre de pas de temps lus à la fois lors des parcours du cube
+TAILLE_BLOC = 366 * 24
+
+class CubeStations(object):
+    '''Cube dense (station, temps, variable) stocké sur disque.
+
+    La donnée est un fichier `.npy` projeté en mémoire et l'index JSON
+    donne les identifiants des stations, les variables, l'origine, le
+    pas de temps et les tranches de temps déjà remplies. Les positions
+    d'une station et d'une période se calculent directement, sans lire
+    la donnée.'''
+    def __init__(self, dossier, mode='r'):
+        self.dossier = Path(dossier)
+        with open(self.dossier / NOM_INDEX) as f:
+            index = json.load(f)
+        self.id_stations = pd.Index(index['id_stations'],
+                                    name=index['noms_index'][0])
+        self.nom_time = index['noms_index'][1]
+        self.variables = index['variables']
+        self.origine = pd.Timestamp(index['origine'])
+        self.pas = pd.Timedelta(seconds=index['pas'])
+        # Tranches [début, fin[ des pas de temps remplis
+        self.remplies = index.get('remplies', [])
+        self.donnee = np.load(self.dossier / NOM_DONNEE, mmap_mode=mode)
+
+    @classmethod
+    def creer(cls, dossier, id_stations, variables, date_deb, date_fin, pas,
+              noms_index=None):
+        '''Création d'un cube vide (NaN) couvrant [date_deb, date_fin].'''
+        dossier = Path(dossier)
+        dossier.mkdir(parents=True, exist_ok=True)
+        origine = pd.Timestamp(date_deb)
+        pas = pd.Timedelta(pas)
+        nombre_temps = (pd.Timestamp(date_fin) - origine) // pas + 1
+        donnee = np.lib.format.open_memmap(
+            dossier / NOM_DONNEE, mode='w+', dtype=DTYPE,
+            shape=(len(id_stations), nombre_temps, len(variables)))
+        donnee[:] = np.nan
+        donnee.flush()
+        del donnee
+
+        index = {
+            'id_stations': pd.Index(id_stations).tolist(),
+            'variables': list(variables),
+            'origine': origine.isoformat(),
+            'pas': pas.total_seconds(),
+            'noms_index': noms_index or [pd.Index(id_stations).name, None],
+            'remplies': []
+        }
+        with open(dossier / NOM_INDEX, 'w') as f:
+            json.dump(index, f, indent=1)
+
+        return cls(dossier, mode='r+')
+
+    def _ecrire_index(self):
+        index = {
+            'id_stations': self.id_stations.tolist(),
+            'variables': self.variables,
+            'origine': self.origine.isoformat(),
+            'pas': self.pas.total_seconds(),
+            'noms_index': [self.id_stations.name, self.nom_time],
+            'remplies': self.remplies
+        }
+        filepath_tmp = self.dossier / f"{NOM_INDEX}.tmp"
+        with open(filepath_tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        filepath_tmp.replace(self.dossier / NOM_INDEX)
+
+    @property
+    def time(self):
+        return pd.date_range(self.origine, periods=self.donnee.shape[1],
+                             freq=self.pas, name=self.nom_time)
+
+    def localiser(self, date):
+        '''Date dans le fuseau de l'origine du cube si elle n'en a pas.'''
+        date = pd.Timestamp(date)
+        if (date.tz is None) and (self.origine.tz is not None):
+            date = date.tz_localize(self.origine.tz)
+        return date
+
+    def couvre(self, id_stations, variables, date_deb, date_fin):
+        '''Vrai si le cube contient ces stations, variables et cette période
+        et si cette période a été remplie.'''
+        if not ((self.localiser(date_deb) >= self.origine) and
+                (self.localiser(date_fin) <= self.time[-1])):
+            return False
+        tranche = self.tranche_temps(date_deb, date_fin)
+        return (pd.Index(id_stations).isin(self.id_stations).all() and
+                set(variables) <= set(self.variables) and
+                any((deb <= tranche.start) and (tranche.stop <= fin)
+                    for deb, fin in self.remplies))
+
+    def marquer_remplie(self, date_deb, date_fin):
+        '''Enregistrement dans l'index de la période [date_deb, date_fin]
+        comme remplie, après son écriture.'''
+        tranche = self.tranche_temps(date_deb, date_fin)
+        fusion = []
+        for deb, fin in sorted(self.remplies + [[tranche.start, tranche.stop]]):
+            if (len(fusion) > 0) and (deb <= fusion[-1][1]):
+                fusion[-1][1] = max(fusion[-1][1], fin)
+            else:
+                fusion.append([deb, fin])
+        self.remplies = fusion
+        self._ecrire_index()
+
+    def positions_stations(self, id_stations):
+        positions = self.id_stations.get_indexer(id_stations)
+        if (positions < 0).any():
+            raise ValueError("Stations absentes du cube: "
+                             f"{list(pd.Index(id_stations)[positions < 0])}")
+        return positions
+
+    def positions_variables(self, variables):
+        return [self.variables.index(variable) for variable in variables]
+
+    def tranche_temps(self, date_deb=None, date_fin=None):
+        '''Tranche des pas de temps de [date_deb, date_fin] dans le cube.'''
+        deb = 0
+        fin = self.donnee.shape[1]
+        if date_deb is not None:
+            deb = max(deb, -((self.origine - self.localiser(date_deb)) // self.pas))
+        if date_fin is not None:
+            fin = min(fin, (self.localiser(date_fin) - self.origine) // self.pas + 1)
+
+        return slice(deb, max(deb, fin))
+
+    def lire(self, id_stations=None, date_deb=None, date_fin=None,
+             variables=None):
+        '''Tableau (station, temps, variable) de la sélection, l'indice
+        temporel et les variables. Seule la sélection est lue sur disque.'''
+        tranche = self.tranche_temps(date_deb, date_fin)
+        donnee = self.donnee[:, tranche]
+        if id_stations is not None:
+            donnee = donnee[self.positions_stations(id_stations)]
+        if variables is not None:
+            donnee = donnee[:, :, self.positions_variables(variables)]
+        else:
+            variables = self.variables
+
+        return donnee, self.time[tranche], variables
+
+    def lire_frame(self, id_stations=None, date_deb=None, date_fin=None,
+                   variables=None):
+        '''Sélection sous forme de DataFrame indexé par (station, temps).'''
+        donnee, time, variables = self.lire(
+            id_stations=id_stations, date_deb=date_deb, date_fin=date_fin,
+            variables=variables)
+        id_stations = self.id_stations if id_stations is None else id_stations
+        index = pd.MultiIndex.from_product(
+            [pd.Index(id_stations, name=self.id_stations.name), time])
+        df = pd.DataFrame(donnee.reshape(-1, len(variables)), index=index,
+                          columns=variables)
+
+        return df.dropna(how='all')
+
+    def ecrire(self, df):
+        '''Écriture de la donnée indexée par (station, temps) dans le cube.'''
+        variables = [variable for variable in self.variables if variable in df]
+        i_station = self.positions_stations(df.index.get_level_values(0))
+        ecart = df.index.get_level_values(1) - self.origine
+        i_time = np.asarray(ecart // self.pas)
+        if ((ecart % self.pas != pd.Timedelta(0)).any() or (i_time < 0).any() or
+            (i_time >= self.donnee.shape[1]).any()):
+            raise ValueError("Temps hors de la grille du cube.")
+
+        self.donnee[i_station[:, None], i_time[:, None],
+                    self.positions_variables(variables)] = df[
+                        variables].to_numpy(dtype=DTYPE)
+        self.donnee.flush()
+
+def interpolation_inverse_distance(
+    cube, s_dist_km, date_deb=None, date_fin=None, variables=None,
+    puissance=2, rayon_max_km=None, taille_bloc=TAILLE_BLOC):
+    '''Interpolation pondérée par l'inverse de la distance des stations
+    d'un cube, lu par blocs de `taille_bloc` pas de temps.'''
+    poids = geo.calcul_poids_inverse_distance(
+        s_dist_km, puissance=puissance, rayon_max_km=rayon_max_km)
+    positions = cube.positions_stations(s_dist_km.index)
+    variables = cube.variables if variables is None else variables
+    positions_variables = cube.positions_variables(variables)
+    tranche = cube.tranche_temps(date_deb, date_fin)
+
+    ref = np.empty((tranche.stop - tranche.start, len(variables)))
+    for deb in range(tranche.start, tranche.stop, taille_bloc):
+        fin = min(deb + taille_bloc, tranche.stop)
+        bloc = cube.donnee[:, deb:fin][positions][:, :, positions_variables]
+        ref[deb - tranche.start:fin - tranche.start] = (
+            geo.interpolation_cube_station(bloc, poids))
+
+    return pd.DataFrame(ref, index=cube.time[tranche], columns=variables)
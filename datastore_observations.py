@@ -1,3 +1,7 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import StringIO
 import pandas as pd
 import param
 import panel as pn
@@ -7,6 +11,7 @@ import bilan
 import etp
 import geo
 import meteofrance
+import stockage
 
 # Météo-France API
 METEOFRANCE_API = 'DPPaquetObs'
@@ -21,15 +26,102 @@ VARIABLES_POUR_CALCULS = dict(
 VARIABLES_POUR_CALCULS_SANS_ETP = VARIABLES_POUR_CALCULS.copy()
 del VARIABLES_POUR_CALCULS_SANS_ETP['etp']
 
+# Durée de la période météo glissante
+DUREE_PERIODE = pd.Timedelta(hours=24)
+
+# Nombre maximal de tâches de fond (téléchargements et calculs)
+# simultanées, partagé par toutes les sessions du serveur
+MAX_TACHES_FOND = 4
+EXECUTEUR_TACHES_FOND = ThreadPoolExecutor(
+    max_workers=MAX_TACHES_FOND, thread_name_prefix='taches_fond')
+
 LARGEUR_BOUTONS = 450
+# Pagination côté serveur : seule la page affichée est envoyée au navigateur
+# (les tables sont téléchargées par `menu_telechargement`)
 PARAMS_TABULATOR = dict(
     disabled=True,
-    pagination="local",
+    pagination="remote",
     page_size=8,
     stylesheets=[":host .tabulator {font-size: 10px;}"],
     width=LARGEUR_BOUTONS
 )
 
+def table_repliable(titre, table, replie=True):
+    '''Carte contenant une table qui n'est envoyée au navigateur
+    qu'une fois la carte dépliée.'''
+    carte = pn.Card(title=titre, collapsed=replie, width=LARGEUR_BOUTONS)
+    carte.append(pn.bind(lambda collapsed: None if collapsed else table,
+                         carte.param.collapsed))
+
+    return carte
+
+def menu_telechargement(table, filename, label):
+    '''Nom de fichier et bouton de téléchargement CSV de toute la table.
+
+    Le CSV est écrit sur le serveur au clic : avec la pagination distante,
+    le navigateur n'a que la page affichée, ou rien si la table est repliée.'''
+    dst_filename = pn.widgets.TextInput(
+        name='Entrer nom de fichier', value=filename, width=LARGEUR_BOUTONS)
+
+    def ecrire_csv():
+        sio = StringIO()
+        table.value.to_csv(sio)
+        sio.seek(0)
+        return sio
+
+    bouton_telechargement = pn.widgets.FileDownload(
+        callback=ecrire_csv, filename=filename, label=label,
+        button_type='primary', width=LARGEUR_BOUTONS)
+    dst_filename.link(bouton_telechargement, value='filename')
+
+    return dst_filename, bouton_telechargement
+
+class TacheAnnulee(Exception):
+    pass
+
+class JetonAnnulation(object):
+    '''Annulation d'une tâche de fond par son propre bouton,
+    vérifiée entre ses étapes.'''
+    def __init__(self):
+        self.demandee = False
+        self.bouton = pn.widgets.Button(
+            name="Annuler", button_type='warning', width=LARGEUR_BOUTONS)
+        self.bouton.on_click(self.annuler)
+
+    def annuler(self, event=None):
+        self.demandee = True
+
+    def verifier(self):
+        if self.demandee:
+            raise TacheAnnulee
+
+async def executer_en_fond(fonction, *args, **kwargs):
+    '''Exécution d'une fonction bloquante dans un fil de fond,
+    la boucle d'événements du serveur restant libre.'''
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(
+        EXECUTEUR_TACHES_FOND, partial(fonction, *args, **kwargs))
+
+def lignes_nouvelles(df_fenetre, df):
+    '''Lignes de df postérieures à la dernière heure de leur station
+    dans la fenêtre (toutes celles des stations absentes de la fenêtre).'''
+    derniere_heure = pd.Series(
+        df_fenetre.index.get_level_values(-1),
+        index=df_fenetre.index.get_level_values(0)).groupby(level=0).max()
+    derniere_heure_ligne = pd.DatetimeIndex(
+        derniere_heure.reindex(df.index.get_level_values(0)))
+
+    return df[~(df.index.get_level_values(-1) <= derniere_heure_ligne)]
+
+def glisser_fenetre(df_fenetre, df_nouveau):
+    '''Ajout des nouvelles lignes à la fenêtre et suppression
+    de celles sorties de la période glissante.'''
+    df = pd.concat([df_fenetre, df_nouveau])
+    time = df.index.get_level_values(-1)
+
+    return df[time > time.max() - DUREE_PERIODE].sort_index()
+
 class DataStoreObservations(pn.viewable.Viewer):
     application_id = param.String(
         doc="""Entrer l'Application ID de l'API Météo-France ici et cliquer ENTER..."""
@@ -74,6 +166,10 @@ class DataStoreObservations(pn.viewable.Viewer):
         default=False,
         doc="""Cliquer pour lire la donnée météo pour la station de référence au lieu de la télécharger..."""
     )
+    mise_a_jour_incrementale = param.Boolean(
+        default=True,
+        doc="""Cliquer pour ne traiter que les nouvelles heures lors de la mise à jour des dernières 24 h..."""
+    )
     recuperation_donnee_liste_stations_faite = param.Boolean(default=False)
     recuperation_donnee_ref_faite = param.Boolean(default=False)
     selection_stations_plus_proches_faite = param.Boolean(default=False)
@@ -89,6 +185,15 @@ class DataStoreObservations(pn.viewable.Viewer):
             
         # Initialisation d'un client pour accéder à l'API Météo-France
         self._client = meteofrance.Client(METEOFRANCE_API)
+
+        # Fenêtres glissantes des dernières 24 h (stations, référence
+        # interpolée et en unités SI), les nouvelles lignes des stations
+        # et la clé (stations et référence) à laquelle elles correspondent
+        self._fenetre_meteo = None
+        self._fenetre_meteo_ref_heure = None
+        self._fenetre_meteo_ref_heure_si = None
+        self._meteo_nouveau = None
+        self._cle_fenetre = None
         
         # Donnée
         self.tab_liste_stations = pn.widgets.Tabulator(
@@ -183,6 +288,9 @@ class DataStoreObservations(pn.viewable.Viewer):
         self._lire_dernieres24h_widget = pn.widgets.Checkbox.from_param(
             self.param.lire_dernieres24h,
             name="Récupérer les dernières 24 h")
+        self._mise_a_jour_incrementale_widget = pn.widgets.Checkbox.from_param(
+            self.param.mise_a_jour_incrementale,
+            name="Ne traiter que les nouvelles heures à chaque mise à jour")
         self._sortie_date_deb = pn.bind(
             self._montrer_date_deb_widget, self._date_fin_widget)
         self._sortie_dates = pn.bind(
@@ -212,6 +320,21 @@ class DataStoreObservations(pn.viewable.Viewer):
         self._sortie_donnee_ref = pn.bind(
             self._recuperer_donnee_ref, self._bouton_donnee_ref)
 
+    def _suivi(self, annulation, message, etape=None, nombre_etapes=None):
+        '''Progression d'une tâche de fond (indéterminée sans étapes)
+        et bouton d'annulation de cette tâche.'''
+        valeur = -1
+        if etape is not None:
+            valeur = int(100 * etape / max(nombre_etapes, 1))
+        progression = pn.indicators.Progress(
+            value=valeur, max=100, active=(valeur < 0), width=LARGEUR_BOUTONS)
+
+        return pn.Column(
+            pn.pane.Alert(message, alert_type="info"),
+            progression,
+            annulation.bouton
+        )
+
     def _sortie_application_id(self):
         return pn.Column(
             pn.pane.Markdown("### Accès à l'API Météo-France"),
@@ -264,50 +387,59 @@ class DataStoreObservations(pn.viewable.Viewer):
                 self._sortie_liste_stations
             )
 
-    def _recuperer_liste_stations(self, event):
-        sortie = None
-        if event:
-            # Écraser la liste des stations précédente
-            self.tab_liste_stations.value = pd.DataFrame()
-            try:
-                filepath = meteofrance.get_filepath_liste_stations(
-                    self._client)
-                if self._lire_liste_stations_widget.value:
-                    # Lecture de la liste des stations
-                    self.tab_liste_stations.value = pd.read_csv(
-                        filepath, index_col=self._client.id_station_label)
-                    msg = pn.pane.Alert("Liste des stations lue.",
-                                        alert_type="success")
-                else:
-                    # Demande de la liste des stations
-                    section = meteofrance.SECTION_LISTE_STATIONS
-                    response = meteofrance.demande(self._client, section)
-                    self.tab_liste_stations.value = meteofrance.response_text_to_frame(
-                        self._client, response, index_col=self._client.id_station_label)
-                    # Sauvegarde de la liste des stations
-                    self.tab_liste_stations.value.to_csv(filepath)
-                    msg = pn.pane.Alert("Liste des stations téléchargée.", 
-                                        alert_type="success")
-
-                assert len(self.tab_liste_stations.value) != 0, (
-                    "La table de la liste des stations est vide!")
-                
-                dst_filename, bouton_telechargement = self.tab_liste_stations.download_menu(
-                    text_kwargs={'name': 'Entrer nom de fichier', 'value': filepath.name},
-                    button_kwargs={'name': 'Télécharger la liste des stations'}
-                )
-                sortie = pn.Column(
-                    msg,
-                    self.tab_liste_stations,
-                    dst_filename,
-                    bouton_telechargement,
-                )
-                self.recuperation_liste_stations_faite = True
-            except Exception as exc:
-                sortie = pn.pane.Str(traceback.format_exc())
-            return sortie
-        else:
-            return sortie
+    async def _recuperer_liste_stations(self, event):
+        if not event:
+            yield None
+            return
+        # Écraser la liste des stations précédente
+        self.tab_liste_stations.value = pd.DataFrame()
+        annulation = JetonAnnulation()
+        try:
+            filepath = meteofrance.get_filepath_liste_stations(
+                self._client)
+            if self._lire_liste_stations_widget.value:
+                # Lecture de la liste des stations
+                yield self._suivi(
+                    annulation, "Lecture de la liste des stations...")
+                df_liste_stations = await executer_en_fond(
+                    stockage.lire, filepath,
+                    index_col=self._client.id_station_label)
+                msg = pn.pane.Alert("Liste des stations lue.",
+                                    alert_type="success")
+            else:
+                # Demande de la liste des stations, partagée entre les sessions
+                yield self._suivi(
+                    annulation, "Téléchargement de la liste des stations...")
+                df_liste_stations = await executer_en_fond(
+                    meteofrance.lire_liste_stations, self._client,
+                    index_col=self._client.id_station_label)
+                annulation.verifier()
+                # Sauvegarde de la liste des stations
+                await executer_en_fond(stockage.ecrire, df_liste_stations, filepath)
+                msg = pn.pane.Alert("Liste des stations téléchargée.", 
+                                    alert_type="success")
+            annulation.verifier()
+            self.tab_liste_stations.value = df_liste_stations
+
+            assert len(self.tab_liste_stations.value) != 0, (
+                "La table de la liste des stations est vide!")
+            
+            dst_filename, bouton_telechargement = menu_telechargement(
+                self.tab_liste_stations, filepath.with_suffix('.csv').name,
+                'Télécharger la liste des stations')
+            sortie = pn.Column(
+                msg,
+                table_repliable("Liste des stations", self.tab_liste_stations),
+                dst_filename,
+                bouton_telechargement,
+            )
+            self.recuperation_liste_stations_faite = True
+        except TacheAnnulee:
+            sortie = pn.pane.Alert("Récupération de la liste des stations annulée.",
+                                   alert_type="warning")
+        except Exception as exc:
+            sortie = pn.pane.Str(traceback.format_exc())
+        yield sortie
 
     def _montrer_bouton_liste_stations_nn(
         self, ref_station_name, ref_station_altitude,
@@ -366,17 +498,17 @@ class DataStoreObservations(pn.viewable.Viewer):
                 self.tab_liste_stations_nn.value = geo.selection_stations_plus_proches(
                     self.tab_liste_stations.value, ref_station_latlon,
                     self._client.latlon_labels,
-                    rayon_km=self._nn_rayon_km_widget.value)
+                    rayon_km=self._nn_rayon_km_widget.value,
+                    dossier_index=meteofrance.DATA_DIR / self._client.api)
 
                 assert len(self.tab_liste_stations_nn.value) != 0, (
                     "La table de la liste des stations les plus proches est vide!")
 
                 filepath = meteofrance.get_filepath_liste_stations_nn(
                     self._client, self.ref_station_name, self.tab_liste_stations_nn.value)
-                dst_filename, bouton_telechargement = self.tab_liste_stations_nn.download_menu(
-                    text_kwargs={'name': 'Entrer nom de fichier', 'value': filepath.name},
-                    button_kwargs={'name': 'Télécharger la liste des stations les plus proches'}
-                )
+                dst_filename, bouton_telechargement = menu_telechargement(
+                    self.tab_liste_stations_nn, filepath.with_suffix('.csv').name,
+                    'Télécharger la liste des stations les plus proches')
                 sortie = pn.Column(
                     pn.pane.Alert("Stations les plus proches sélectionnées.",
                                   alert_type="success"),
@@ -416,7 +548,8 @@ class DataStoreObservations(pn.viewable.Viewer):
             "### Définition de la période météo (stations et référence)")
         sortie_base = pn.Column(
             titre,
-            self._lire_dernieres24h_widget
+            self._lire_dernieres24h_widget,
+            self._mise_a_jour_incrementale_widget
         )
         sortie = sortie_base
         self._lire_dernieres24h_widget.name = (
@@ -455,56 +588,118 @@ class DataStoreObservations(pn.viewable.Viewer):
                 self._sortie_donnee_liste_stations
             )
 
-    def _recuperer_donnee_liste_stations(self, event):
-        sortie = None
-        if event:
-            # Écraser donnee météo pour la liste des stations précédente
-            self.tab_meteo.value = pd.DataFrame()
-            try:
-                filepath = meteofrance.get_filepath_donnee_periode(
-                    self._client, self.ref_station_name, self.tab_liste_stations_nn.value,
-                    self._date_deb_widget.value, self._date_fin_widget.value)
-                if self._lire_donnee_liste_stations_widget.value:
-                    # Lecture de la donnée météo pour la liste des stations
-                    self.tab_meteo.value = pd.read_csv(
-                        filepath, parse_dates=[self._client.time_label],
-                        index_col=[self._client.id_station_donnee_label,
-                                   self._client.time_label])
-                    msg = pn.pane.Alert("Donnée météo pour la liste des stations lue.",
-                                        alert_type="success")
+    def _get_cle_fenetre(self):
+        '''Stations et référence auxquelles correspondent les fenêtres glissantes.'''
+        return (tuple(self.tab_liste_stations_nn.value.index),
+                self._ref_station_lat_widget.value,
+                self._ref_station_lon_widget.value,
+                self._ref_station_altitude_widget.value)
+
+    def _mise_a_jour_incrementale_possible(self):
+        return (self._mise_a_jour_incrementale_widget.value and
+                (self._fenetre_meteo is not None) and
+                (self._cle_fenetre == self._get_cle_fenetre()))
+
+    async def _recuperer_donnee_liste_stations(self, event):
+        if not event:
+            yield None
+            return
+        # Écraser donnee météo pour la liste des stations précédente
+        self.tab_meteo.value = pd.DataFrame()
+        annulation = JetonAnnulation()
+        try:
+            filepath = meteofrance.get_filepath_donnee_periode(
+                self._client, self.ref_station_name, self.tab_liste_stations_nn.value,
+                self._date_deb_widget.value, self._date_fin_widget.value)
+            if self._lire_donnee_liste_stations_widget.value:
+                # Lecture de la donnée météo pour la liste des stations
+                yield self._suivi(
+                    annulation,
+                    "Lecture de la donnée météo pour la liste des stations...")
+                df_meteo = await executer_en_fond(
+                    stockage.lire, filepath, parse_dates=[self._client.time_label],
+                    index_col=[self._client.id_station_donnee_label,
+                               self._client.time_label])
+                annulation.verifier()
+                # La donnée lue ne prolonge pas la fenêtre glissante
+                self._fenetre_meteo = None
+                self._meteo_nouveau = None
+                self.tab_meteo.value = df_meteo
+                msg = pn.pane.Alert("Donnée météo pour la liste des stations lue.",
+                                    alert_type="success")
+            else:
+                # Demande de la donnée météo pour la liste des stations pour les dernières 24 h,
+                # département par département pour suivre la progression
+                variables = [self._client.variables_labels[METEOFRANCE_FREQUENCE][k]
+                     for k in VARIABLES_POUR_CALCULS_SANS_ETP]
+                df_liste_stations = self.tab_liste_stations_nn.value
+                nombre_departements = len(
+                    meteofrance.liste_id_stations_vers_liste_id_departements(
+                        df_liste_stations))
+                iterateur = meteofrance.iterer_donnee_des_departements(
+                    self._client, df_liste_stations,
+                    frequence=METEOFRANCE_FREQUENCE)
+                l_df = []
+                try:
+                    while True:
+                        yield self._suivi(
+                            annulation,
+                            "Téléchargement des paquets des départements...",
+                            len(l_df), nombre_departements)
+                        df_departement = await executer_en_fond(next, iterateur, None)
+                        if df_departement is None:
+                            break
+                        l_df.append(df_departement)
+                        annulation.verifier()
+                finally:
+                    # La fermeture attend les requêtes en cours, hors de la boucle
+                    await executer_en_fond(iterateur.close)
+                df_meteo = meteofrance.assembler_donnee_des_departements(
+                    self._client, l_df, df_liste_stations)[variables]
+
+                if self._mise_a_jour_incrementale_possible():
+                    # Seules les heures absentes de la fenêtre sont ajoutées,
+                    # et accumulées jusqu'au prochain calcul de la référence
+                    df_nouveau = lignes_nouvelles(self._fenetre_meteo, df_meteo)
+                    df_meteo = glisser_fenetre(self._fenetre_meteo, df_nouveau)
+                    if self._meteo_nouveau is not None:
+                        df_nouveau = glisser_fenetre(self._meteo_nouveau, df_nouveau)
+                    self._meteo_nouveau = df_nouveau
                 else:
-                    # Demande de la donnée météo pour la liste des stations pour les dernières 24 h
-                    variables = [self._client.variables_labels[METEOFRANCE_FREQUENCE][k]
-                         for k in VARIABLES_POUR_CALCULS_SANS_ETP]
-                    self.tab_meteo.value = meteofrance.compiler_donnee_des_departements(
-                        self._client, self.tab_liste_stations_nn.value,
-                        frequence=METEOFRANCE_FREQUENCE)[variables]
-    
-                    # Sauvegarde de la donnée météo pour la liste des stations
-                    self.tab_meteo.value.to_csv(filepath)
-                    msg = pn.pane.Alert("Donnée météo pour la liste des stations téléchargée.",
-                                        alert_type="success")
-
-                assert len(self.tab_meteo.value) != 0, (
-                    "La table de la donnée météo pour la liste des stations est vide!")
-                    
-                dst_filename, bouton_telechargement = self.tab_meteo.download_menu(
-                    text_kwargs={'name': 'Entrer nom de fichier',
-                                 'value': filepath.name},
-                    button_kwargs={'name': 'Télécharger la donnée météo pour la liste des stations'}
-                )
-                sortie = pn.Column(
-                    msg,
-                    self.tab_meteo,
-                    dst_filename,
-                    bouton_telechargement
-                )
-                self.recuperation_donnee_liste_stations_faite = True
-            except Exception as exc:
-                sortie = pn.pane.Str(traceback.format_exc())
-            return sortie
-        else:
-            return sortie
+                    # Les fenêtres de la référence sont recalculées
+                    self._meteo_nouveau = None
+                    self._fenetre_meteo_ref_heure = None
+                    self._fenetre_meteo_ref_heure_si = None
+                self._fenetre_meteo = df_meteo
+                self._cle_fenetre = self._get_cle_fenetre()
+                self.tab_meteo.value = df_meteo
+
+                # Sauvegarde de la donnée météo pour la liste des stations
+                await executer_en_fond(stockage.ecrire, df_meteo, filepath)
+                msg = pn.pane.Alert("Donnée météo pour la liste des stations téléchargée.",
+                                    alert_type="success")
+
+            assert len(self.tab_meteo.value) != 0, (
+                "La table de la donnée météo pour la liste des stations est vide!")
+                
+            dst_filename, bouton_telechargement = menu_telechargement(
+                self.tab_meteo, filepath.with_suffix('.csv').name,
+                'Télécharger la donnée météo pour la liste des stations')
+            sortie = pn.Column(
+                msg,
+                table_repliable("Donnée météo pour la liste des stations",
+                                self.tab_meteo),
+                dst_filename,
+                bouton_telechargement
+            )
+            self.recuperation_donnee_liste_stations_faite = True
+        except TacheAnnulee:
+            sortie = pn.pane.Alert(
+                "Récupération de la donnée météo pour la liste des stations annulée.",
+                alert_type="warning")
+        except Exception as exc:
+            sortie = pn.pane.Str(traceback.format_exc())
+        yield sortie
 
     def _montrer_donnee_ref_widgets(
         self, recuperation_donnee_liste_stations_faite, lire_donnee_ref
@@ -525,78 +720,157 @@ class DataStoreObservations(pn.viewable.Viewer):
                 self._sortie_donnee_ref
             )
 
-    def _recuperer_donnee_ref(self, event):
-        sortie = None
-        if event:
-            # Écraser donnee météo pour la station de référence précédente
-            self.tab_meteo_ref_heure_si.value = pd.DataFrame()
-            self.tab_meteo_ref_si.value = pd.DataFrame()
-            try: 
-                filepath = meteofrance.get_filepath_donnee_periode(
-                    self._client, self.ref_station_name, self.tab_liste_stations_nn.value,
-                    self._date_deb_widget.value, self._date_fin_widget.value, ref=True)
-                if self._lire_donnee_ref_widget.value:
-                    # Lecture de la donnée météo pour la station de référence
-                    df_meteo_ref_heure = pd.read_csv(
-                        filepath, parse_dates=[self._client.time_label],
-                        index_col=self._client.time_label)
-                    msg = pn.pane.Alert("Donnée météo pour la station de référence lue.",
-                                        alert_type="success")
-                else:
-                    # Demande de la donnée météo pour la station de référence
-                    df_meteo_ref_heure = geo.interpolation_inverse_distance_carre(
-                        self.tab_meteo.value, self.tab_liste_stations_nn.value['distance'])
-    
-                    # Sauvegarde de la donnée météo pour la station de référence
-                    df_meteo_ref_heure.to_csv(filepath)
-                    msg = pn.pane.Alert("Donnée météo pour la station de référence interpolée.",
-                                           alert_type="success")
-
-                df_meteo_ref_heure_renom = meteofrance.renommer_variables(
-                    self._client, df_meteo_ref_heure, METEOFRANCE_FREQUENCE)
-
-
-                df_meteo_ref_heure_si = meteofrance.convertir_unites(
-                    self._client, df_meteo_ref_heure_renom)
-
-                df_meteo_ref_heure_si['etp'] = etp.calcul_etp(
-                    df_meteo_ref_heure_si,
-                    self._ref_station_lat_widget.value,
-                    self._ref_station_lon_widget.value,
-                    self._ref_station_altitude_widget.value)
-
-                # Calcul des valeurs journalières des variables météo
-                df_meteo_ref_si = pd.DataFrame()
-                for variable, series in df_meteo_ref_heure_si.items():
-                    df_meteo_ref_si[variable] = [
-                        getattr(df_meteo_ref_heure_si[variable],
-                                VARIABLES_POUR_CALCULS[variable])(0)]
-                df_meteo_ref_si.index = [(
-                    f"{df_meteo_ref_heure_si.index.min()} - "
-                    f"{df_meteo_ref_heure_si.index.max()}")]
-
-                self.tab_meteo_ref_heure_si.value = df_meteo_ref_heure_si
-                self.tab_meteo_ref_si.value = df_meteo_ref_si
-
-                assert len(self.tab_meteo_ref_si.value) != 0, (
-                    "La table de la donnée météo pour la station de référence est vide!")
-                
-                dst_filename, bouton_telechargement = self.tab_meteo_ref_heure_si.download_menu(
-                    text_kwargs={'name': 'Entrer nom de fichier', 'value': filepath.name},
-                    button_kwargs={'name': 'Télécharger la donnée météo pour la station de référence'}
-                )
-                sortie = pn.Column(
-                    msg,
-                    self.tab_meteo_ref_heure_si,
-                    dst_filename,
-                    bouton_telechargement,
-                )
-                self.recuperation_donnee_ref_faite = True
-            except Exception as exc:
-                sortie = pn.pane.Str(traceback.format_exc())
-            return sortie
+    def _calcul_meteo_ref_heure_si(self, df_meteo_ref_heure, site,
+                                   df_contexte_si=None):
+        '''Conversion en unités SI et calcul de l'ETP de la donnée de référence
+        pour le site (latitude, longitude, altitude).
+
+        Les heures du contexte précèdent la donnée pour le remplissage
+        nocturne de la clareté, seule l'ETP de la donnée étant gardée.'''
+        df_meteo_ref_heure_renom = meteofrance.renommer_variables(
+            self._client, df_meteo_ref_heure, METEOFRANCE_FREQUENCE)
+
+        df_meteo_ref_heure_si = meteofrance.convertir_unites(
+            self._client, df_meteo_ref_heure_renom)
+
+        df_calcul = df_meteo_ref_heure_si
+        if df_contexte_si is not None:
+            df_calcul = pd.concat([
+                df_contexte_si[df_meteo_ref_heure_si.columns],
+                df_meteo_ref_heure_si])
+        df_meteo_ref_heure_si['etp'] = etp.calcul_etp(df_calcul, *site).loc[
+            df_meteo_ref_heure_si.index]
+
+        return df_meteo_ref_heure_si
+
+    def _etat_donnee_ref(self):
+        '''Valeurs des widgets et des fenêtres utilisées par le calcul de la
+        référence, lues sur la boucle d'événements avant de le lancer.'''
+        return {
+            'lire': self._lire_donnee_ref_widget.value,
+            'df_meteo': self.tab_meteo.value,
+            'distances': self.tab_liste_stations_nn.value.get('distance'),
+            'site': (self._ref_station_lat_widget.value,
+                     self._ref_station_lon_widget.value,
+                     self._ref_station_altitude_widget.value),
+            'meteo_nouveau': self._meteo_nouveau,
+            'fenetre_meteo_ref_heure': self._fenetre_meteo_ref_heure,
+            'fenetre_meteo_ref_heure_si': self._fenetre_meteo_ref_heure_si
+        }
+
+    def _calculer_donnee_ref(self, filepath, etat):
+        '''Donnée météo horaire de la référence, brute et en unités SI,
+        et message de succès. Exécuté dans un fil de fond, à partir de
+        l'état lu par `_etat_donnee_ref` sans accéder aux widgets.'''
+        df_meteo_ref_heure_si = None
+        if etat['lire']:
+            # Lecture de la donnée météo pour la station de référence
+            df_meteo_ref_heure = stockage.lire(
+                filepath, parse_dates=[self._client.time_label],
+                index_col=self._client.time_label)
+            texte = "Donnée météo pour la station de référence lue."
+        elif ((etat['meteo_nouveau'] is not None) and
+              (etat['fenetre_meteo_ref_heure_si'] is not None)):
+            # Interpolation et ETP des seules heures depuis la plus ancienne
+            # des nouvelles lignes, remplacées dans les fenêtres de la référence
+            nombre_heures = 0
+            df_meteo_ref_heure = etat['fenetre_meteo_ref_heure']
+            df_meteo_ref_heure_si = etat['fenetre_meteo_ref_heure_si']
+            if len(etat['meteo_nouveau']) > 0:
+                heure_min = etat['meteo_nouveau'].index.get_level_values(-1).min()
+                df_meteo = etat['df_meteo']
+                df_nouveau_ref_heure = geo.interpolation_inverse_distance_carre(
+                    df_meteo[df_meteo.index.get_level_values(-1) >= heure_min],
+                    etat['distances'])
+                df_contexte_si = df_meteo_ref_heure_si[
+                    df_meteo_ref_heure_si.index < heure_min]
+                df_nouveau_ref_heure_si = self._calcul_meteo_ref_heure_si(
+                    df_nouveau_ref_heure, etat['site'],
+                    df_contexte_si=df_contexte_si)
+                df_meteo_ref_heure = glisser_fenetre(
+                    df_meteo_ref_heure[df_meteo_ref_heure.index < heure_min],
+                    df_nouveau_ref_heure)
+                df_meteo_ref_heure_si = glisser_fenetre(
+                    df_contexte_si, df_nouveau_ref_heure_si)
+                nombre_heures = len(df_nouveau_ref_heure)
+
+            stockage.ecrire(df_meteo_ref_heure, filepath)
+            texte = (f"Donnée météo pour la station de référence mise à jour "
+                     f"({nombre_heures:d} heure(s) recalculée(s)).")
         else:
-            return sortie
+            # Demande de la donnée météo pour la station de référence
+            df_meteo_ref_heure = geo.interpolation_inverse_distance_carre(
+                etat['df_meteo'], etat['distances'])
+
+            # Sauvegarde de la donnée météo pour la station de référence
+            stockage.ecrire(df_meteo_ref_heure, filepath)
+            texte = "Donnée météo pour la station de référence interpolée."
+
+        if df_meteo_ref_heure_si is None:
+            df_meteo_ref_heure_si = self._calcul_meteo_ref_heure_si(
+                df_meteo_ref_heure, etat['site'])
+
+        return df_meteo_ref_heure, df_meteo_ref_heure_si, texte
+
+    async def _recuperer_donnee_ref(self, event):
+        if not event:
+            yield None
+            return
+        # Écraser donnee météo pour la station de référence précédente
+        self.tab_meteo_ref_heure_si.value = pd.DataFrame()
+        self.tab_meteo_ref_si.value = pd.DataFrame()
+        annulation = JetonAnnulation()
+        try: 
+            filepath = meteofrance.get_filepath_donnee_periode(
+                self._client, self.ref_station_name, self.tab_liste_stations_nn.value,
+                self._date_deb_widget.value, self._date_fin_widget.value, ref=True)
+            yield self._suivi(
+                annulation,
+                "Interpolation et calcul de l'ETP pour la station de référence...")
+            etat = self._etat_donnee_ref()
+            df_meteo_ref_heure, df_meteo_ref_heure_si, texte = await executer_en_fond(
+                self._calculer_donnee_ref, filepath, etat)
+            annulation.verifier()
+            # Les lignes arrivées pendant le calcul restent à traiter
+            if self._meteo_nouveau is etat['meteo_nouveau']:
+                self._meteo_nouveau = None
+            self._fenetre_meteo_ref_heure = df_meteo_ref_heure
+            self._fenetre_meteo_ref_heure_si = df_meteo_ref_heure_si
+            msg = pn.pane.Alert(texte, alert_type="success")
+
+            # Calcul des valeurs journalières des variables météo
+            df_meteo_ref_si = pd.DataFrame()
+            for variable, series in df_meteo_ref_heure_si.items():
+                df_meteo_ref_si[variable] = [
+                    getattr(df_meteo_ref_heure_si[variable],
+                            VARIABLES_POUR_CALCULS[variable])(0)]
+            df_meteo_ref_si.index = [(
+                f"{df_meteo_ref_heure_si.index.min()} - "
+                f"{df_meteo_ref_heure_si.index.max()}")]
+
+            self.tab_meteo_ref_heure_si.value = df_meteo_ref_heure_si
+            self.tab_meteo_ref_si.value = df_meteo_ref_si
+
+            assert len(self.tab_meteo_ref_si.value) != 0, (
+                "La table de la donnée météo pour la station de référence est vide!")
+            
+            dst_filename, bouton_telechargement = menu_telechargement(
+                self.tab_meteo_ref_heure_si, filepath.with_suffix('.csv').name,
+                'Télécharger la donnée météo pour la station de référence')
+            sortie = pn.Column(
+                msg,
+                self.tab_meteo_ref_heure_si,
+                dst_filename,
+                bouton_telechargement,
+            )
+            self.recuperation_donnee_ref_faite = True
+        except TacheAnnulee:
+            sortie = pn.pane.Alert(
+                "Récupération de la donnée météo pour la station de référence annulée.",
+                alert_type="warning")
+        except Exception as exc:
+            sortie = pn.pane.Str(traceback.format_exc())
+        yield sortie
 
     def __panel__(self):
         p = pn.Column(
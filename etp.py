@@ -1,7 +1,18 @@
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import os
 import pandas as pd
+from pathlib import Path
 from pvlib import irradiance, location
 import pytz
+import threading
+
+import meteofrance
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 # Variables météorologiques utilisées pour le calcul de l'ETP
 # et leur méthode d'aggrégation journalière
@@ -27,6 +38,22 @@ ALPHA = 0.23
 # Émissivité
 EPSILON = 1.0
 
+# Constante solaire (W m-2)
+CONSTANTE_SOLAIRE = 1366.1
+
+# Époque J2000 des équations de position du soleil
+J2000 = pd.Timestamp('2000-01-01T12:00:00')
+
+# Moteurs de calcul du zénith solaire et moteur par défaut
+MOTEURS = ['numpy', 'numba']
+MOTEUR = 'numpy'
+
+# Dossier du cache de géométrie solaire
+DOSSIER_GEOMETRIE_SOLAIRE = meteofrance.DATA_DIR / 'geometrie_solaire'
+
+# Nombre de décimales des coordonnées (degrés) des sites dans ce cache
+DECIMALES_COORDONNEES = 2
+
 def calcul_rayonnement_net_ondes_courtes(df):
     # Rayonnement solaire incident en MJ m-2 h-1
     r_s = df['rayonnement_global'] * 1.e-6
@@ -36,29 +63,124 @@ def calcul_rayonnement_net_ondes_courtes(df):
 
     return r_ns
 
-def calcul_rayonnement_net_ondes_longues(df, ee, site):
-    # Rayonnement solaire incident en MJ m-2 h-1
-    r_s = df['rayonnement_global'] * 1.e-6
-
+def calcul_geometrie_solaire(time, site):
+    '''Zénith solaire (degrés) et rayonnement extraterrestre normal
+    (MJ m-2 h-1) calculés par pvlib.'''
     # Localisation du temps
-    time = pd.DatetimeIndex(df.index)
-    local_time = time.tz_convert(site.tz)
+    local_time = pd.DatetimeIndex(time).tz_convert(site.tz)
 
-    # Calcul du rayonnement extraterrestre normal
+    # Calcul du rayonnement extraterrestre normal
     r_a_dni = irradiance.get_extra_radiation(local_time) * 3600 * 1.e-6
 
     # Calcul du zenith solaire
     zenith = site.get_solarposition(times=local_time)['zenith']
 
-    # Calcul du rayonnement extraterrestre horizontal
+    return zenith.to_numpy(), r_a_dni.to_numpy()
+
+class GeometrieSolaire(object):
+    '''Cache de la géométrie solaire des sites.
+
+    Le zénith et le rayonnement extraterrestre ne dépendent que du site
+    et de l'heure : ils sont calculés une fois pour toutes les heures
+    d'une année, pour les coordonnées arrondies à `DECIMALES_COORDONNEES`
+    décimales, conservés en mémoire et sauvegardés en float32 sur disque.'''
+    def __init__(self, dossier=DOSSIER_GEOMETRIE_SOLAIRE):
+        self.dossier = Path(dossier)
+        self._annees = {}
+        self._verrou = threading.Lock()
+
+    def __getstate__(self):
+        # Seul le dossier est transmis aux processus, qui relisent les fichiers
+        return {'dossier': self.dossier}
+
+    def __setstate__(self, etat):
+        self.__init__(etat['dossier'])
+
+    @staticmethod
+    def cle(latitude, longitude, altitude, annee):
+        return (round(float(latitude), DECIMALES_COORDONNEES),
+                round(float(longitude), DECIMALES_COORDONNEES),
+                round(float(altitude)), int(annee))
+
+    def get_filepath(self, cle):
+        latitude, longitude, altitude, annee = cle
+        return self.dossier / (f"geometrie_{latitude:.{DECIMALES_COORDONNEES}f}_"
+                               f"{longitude:.{DECIMALES_COORDONNEES}f}_"
+                               f"{altitude:d}_{annee:d}.npz")
+
+    def annee(self, latitude, longitude, altitude, annee):
+        '''Zénith et rayonnement extraterrestre de toutes les heures (UTC) d'une année.'''
+        cle = self.cle(latitude, longitude, altitude, annee)
+        with self._verrou:
+            if cle in self._annees:
+                return self._annees[cle]
+
+        # Lecture ou calcul hors du verrou pour ne pas bloquer les autres sites
+        filepath = self.get_filepath(cle)
+        if filepath.exists():
+            with np.load(filepath) as f:
+                geometrie = (f['zenith'], f['r_a_dni'])
+        else:
+            time = pd.date_range(
+                f'{annee:d}-01-01', f'{annee:d}-12-31 23:00',
+                freq='h', tz='UTC')
+            site = location.Location(
+                cle[0], cle[1], altitude=cle[2],
+                tz=pytz.country_timezones('FR')[0])
+            zenith, r_a_dni = calcul_geometrie_solaire(time, site)
+            geometrie = (zenith.astype(np.float32), r_a_dni.astype(np.float32))
+            self.dossier.mkdir(parents=True, exist_ok=True)
+            filepath_tmp = filepath.with_name(
+                f"{filepath.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(filepath_tmp, 'wb') as f:
+                np.savez(f, zenith=geometrie[0], r_a_dni=geometrie[1])
+            filepath_tmp.replace(filepath)
+
+        with self._verrou:
+            return self._annees.setdefault(cle, geometrie)
+
+    def lire(self, time, latitude, longitude, altitude):
+        '''Zénith (degrés) et rayonnement extraterrestre normal (MJ m-2 h-1)
+        aux heures données, lus dans les années en cache.'''
+        time = pd.DatetimeIndex(time).tz_convert('UTC')
+        zenith = np.empty(len(time))
+        r_a_dni = np.empty(len(time))
+        debut_annee = time.normalize() - pd.to_timedelta(
+            time.dayofyear - 1, unit='D')
+        heures = ((time - debut_annee) // pd.Timedelta(hours=1)).to_numpy()
+        annees = time.year.to_numpy()
+        for annee in np.unique(annees):
+            selection = annees == annee
+            zenith_annee, r_a_dni_annee = self.annee(
+                latitude, longitude, altitude, annee)
+            zenith[selection] = zenith_annee[heures[selection]]
+            r_a_dni[selection] = r_a_dni_annee[heures[selection]]
+
+        return zenith, r_a_dni
+
+# Cache de géométrie solaire partagé par défaut
+GEOMETRIE_SOLAIRE = GeometrieSolaire()
+
+def calcul_rayonnement_net_ondes_longues(df, ee, site, geometrie=GEOMETRIE_SOLAIRE):
+    # Rayonnement solaire incident en MJ m-2 h-1
+    r_s = df['rayonnement_global'] * 1.e-6
+
+    # Zénith solaire et rayonnement extraterrestre normal, lus dans le cache
+    # si les temps tombent sur des heures pleines
+    time = pd.DatetimeIndex(df.index)
+    if (geometrie is not None) and (time == time.floor('h')).all():
+        zenith, r_a_dni = geometrie.lire(
+            time, site.latitude, site.longitude, site.altitude)
+    else:
+        zenith, r_a_dni = calcul_geometrie_solaire(time, site)
+    zenith = pd.Series(zenith, index=df.index)
+
+    # Calcul du rayonnement extraterrestre horizontal
     r_a = np.maximum(0., r_a_dni * np.cos(np.deg2rad(zenith)))
 
     # Calcul du rayonnement solaire incident pour un ciel clair
     r_so = (0.75 + 2.e-5 * site.altitude) * r_a
 
-    # Conversion du temps vers UTC
-    r_so.index = r_so.index.tz_convert('UTC')
-
     # Calcul de la clareté
     clarete = np.minimum(1., r_s / r_so)
 
@@ -76,8 +198,11 @@ def calcul_rayonnement_net_ondes_longues(df, ee, site):
 
     return r_nl, zenith
 
-def calcul_etp(df, latitude, longitude, altitude):
-    '''Calcul de l'évapotranspiration potentielle pour une station.'''
+def calcul_etp(df, latitude, longitude, altitude, geometrie=GEOMETRIE_SOLAIRE):
+    '''Calcul de l'évapotranspiration potentielle pour une station.
+
+    La géométrie solaire est lue dans le cache `geometrie`
+    (recalculée à chaque appel si None).'''
     tz = pytz.country_timezones('FR')[0]
     site = location.Location(
         latitude, longitude, altitude=altitude, tz=tz)
@@ -100,7 +225,8 @@ def calcul_etp(df, latitude, longitude, altitude):
 
     # Calcul du rayonnement net
     r_ns = calcul_rayonnement_net_ondes_courtes(df)
-    r_nl, zenith = calcul_rayonnement_net_ondes_longues(df, ee, site)
+    r_nl, zenith = calcul_rayonnement_net_ondes_longues(
+        df, ee, site, geometrie=geometrie)
     r_n = r_ns - r_nl
 
     # Calcul du flux du sol
@@ -116,4 +242,233 @@ def calcul_etp(df, latitude, longitude, altitude):
         es - ee) / denominateur)
     etp = etp1 + etp2
 
-    return etp
\ No newline at end of file
+    return etp
+
+def jours_depuis_j2000(time):
+    '''Jours (fractionnaires) écoulés depuis l'époque J2000 (2000-01-01 12h UTC).'''
+    time = pd.DatetimeIndex(time)
+    if time.tz is not None:
+        time = time.tz_convert('UTC').tz_localize(None)
+
+    return ((time - J2000) / pd.Timedelta(days=1)).to_numpy(dtype=float)
+
+def _calcul_zenith_solaire(jours, latitude, longitude):
+    '''Zénith solaire (degrés) par les équations de la NOAA, à partir
+    des jours depuis J2000 et des coordonnées (degrés) du site.'''
+    # Siècles juliens depuis J2000
+    jc = jours / 36525.
+
+    # Longitude et anomalie moyennes du soleil et excentricité de l'orbite
+    l0 = np.deg2rad((280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360.)
+    m = np.deg2rad(357.52911 + jc * (35999.05029 - 0.0001537 * jc))
+    e = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+
+    # Longitude apparente du soleil et obliquité corrigée de l'écliptique
+    c = (np.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc)) +
+         np.sin(2. * m) * (0.019993 - 0.000101 * jc) +
+         np.sin(3. * m) * 0.000289)
+    omega = np.deg2rad(125.04 - 1934.136 * jc)
+    longitude_apparente = np.deg2rad(
+        np.rad2deg(l0) + c - 0.00569 - 0.00478 * np.sin(omega))
+    obliquite = np.deg2rad(23. + (26. + (21.448 - jc * (
+        46.815 + jc * (0.00059 - jc * 0.001813))) / 60.) / 60. +
+        0.00256 * np.cos(omega))
+
+    # Déclinaison et équation du temps (minutes)
+    declinaison = np.arcsin(np.sin(obliquite) * np.sin(longitude_apparente))
+    y = np.tan(obliquite / 2.)**2
+    equation_temps = 4. * np.rad2deg(
+        y * np.sin(2. * l0) - 2. * e * np.sin(m) +
+        4. * e * y * np.sin(m) * np.cos(2. * l0) -
+        0.5 * y**2 * np.sin(4. * l0) - 1.25 * e**2 * np.sin(2. * m))
+
+    # Angle horaire à partir du temps solaire vrai (minutes)
+    minutes_utc = ((jours + 0.5) % 1.) * 1440.
+    temps_solaire = (minutes_utc + equation_temps + 4. * longitude) % 1440.
+    angle_horaire = np.deg2rad(temps_solaire / 4. - 180.)
+
+    latitude_rad = np.deg2rad(latitude)
+    cos_zenith = (np.sin(latitude_rad) * np.sin(declinaison) +
+                  np.cos(latitude_rad) * np.cos(declinaison) *
+                  np.cos(angle_horaire))
+
+    return np.rad2deg(np.arccos(np.minimum(1., np.maximum(-1., cos_zenith))))
+
+if numba is not None:
+    _calcul_zenith_solaire_numba = numba.vectorize(
+        ['float64(float64, float64, float64)'], cache=True)(
+            _calcul_zenith_solaire)
+
+def calcul_zenith_solaire(jours, latitude, longitude, moteur=MOTEUR):
+    '''Zénith solaire (degrés) calculé avec NumPy ou numba.'''
+    if moteur not in MOTEURS:
+        raise ValueError(f"Choix invalide: {moteur}. "
+                         f"Les choix possibles sont: {MOTEURS}")
+    if moteur == 'numba':
+        if numba is None:
+            raise ValueError("Le moteur numba nécessite le paquet numba.")
+        return _calcul_zenith_solaire_numba(
+            np.asarray(jours, dtype=float), np.asarray(latitude, dtype=float),
+            np.asarray(longitude, dtype=float))
+
+    return _calcul_zenith_solaire(jours, latitude, longitude)
+
+def calcul_rayonnement_extraterrestre(jour_annee):
+    '''Rayonnement extraterrestre normal (MJ m-2 h-1) par la méthode de Spencer.'''
+    b = 2. * np.pi / 365. * (jour_annee - 1.)
+    distance = (1.00011 + 0.034221 * np.cos(b) + 0.00128 * np.sin(b) +
+                0.000719 * np.cos(2. * b) + 7.7e-05 * np.sin(2. * b))
+
+    return CONSTANTE_SOLAIRE * distance * 3600 * 1.e-6
+
+def remplir_avant_arriere(x):
+    '''Remplissage des NaN par la dernière valeur valide le long du dernier
+    axe, puis par la première valeur valide pour ceux du début.'''
+    n = x.shape[-1]
+    valide = ~np.isnan(x)
+    positions = np.arange(n)
+
+    # Position de la dernière valeur valide précédente
+    avant = np.maximum.accumulate(np.where(valide, positions, -1), axis=-1)
+
+    # Position de la première valeur valide
+    premiere = np.argmax(valide, axis=-1)[..., None]
+    avant = np.where(avant < 0, premiere, avant)
+
+    return np.take_along_axis(x, avant, axis=-1)
+
+def noyau_etp(temperature, humidite, vent, rayonnement, zenith, r_a_dni,
+              altitude):
+    '''Évapotranspiration potentielle horaire FAO-56 (mm h-1) sur des tableaux.
+
+    Les tableaux météorologiques, le zénith (degrés) et le rayonnement
+    extraterrestre normal (MJ m-2 h-1) ont le temps comme dernier axe.'''
+    # Pression de vapeur saturante (kPa) et pente de la courbe (kPa K-1)
+    es = 0.6108 * np.exp(17.27 * (temperature - 273.15) /
+                         (temperature - 35.85))
+    delta = 4098. * es / (temperature - 35.85)**2
+
+    # Pression standard en fonction de l'altitude (kPa) et constante psychrométrique
+    pression = 101.3 * ((293. - 0.0065 * altitude) / 293.)**5.26
+    gamma = FACTEUR_GAMMA * pression
+
+    # Pression de vapeur effective (kPa)
+    ee = es * humidite
+
+    # Rayonnements solaire incident, extraterrestre horizontal
+    # et par ciel clair (MJ m-2 h-1)
+    r_s = rayonnement * 1.e-6
+    jour = zenith < 90.
+    r_a = np.maximum(0., r_a_dni * np.cos(np.deg2rad(zenith)))
+    r_so = (0.75 + 2.e-5 * altitude) * r_a
+
+    # Clareté, la nuit égale à celle 2h avant le couché
+    # (ou après le levé si ces heures manquent)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        clarete = np.minimum(1., r_s / r_so)
+    jour_court = (np.roll(jour, 1, axis=-1) & np.roll(jour, -1, axis=-1))
+    clarete = remplir_avant_arriere(np.where(jour_court, clarete, np.nan))
+
+    # Rayonnement net
+    r_ns = (1 - ALPHA) * r_s
+    r_nl = SIGMA * temperature**4 * (0.34 - 0.14 * np.sqrt(ee)) * (
+        1.35 * clarete - 0.35)
+    r_n = r_ns - r_nl
+
+    # Flux du sol
+    g_sol = np.where(jour, 0.1 * r_n, 0.5 * r_n)
+
+    # Vitesse du vent à 2 m à partir de celle à 10 m
+    u2 = vent * 4.87 / np.log(67.8 * 10 - 5.42)
+
+    # ETP (mm h-1)
+    denominateur = delta + gamma * (1. + 0.34 * u2)
+    etp1 = np.maximum(0, delta * (r_n - g_sol) / LAMBDA / denominateur)
+    etp2 = np.maximum(0, gamma * 37. / temperature * u2 * (
+        es - ee) / denominateur)
+
+    return etp1 + etp2
+
+def calcul_etp_numpy(df, latitude, longitude, altitude, moteur=MOTEUR,
+                     geometrie=None):
+    '''Calcul de l'évapotranspiration potentielle pour une station
+    par le noyau NumPy, sans pvlib.
+
+    Si un cache `geometrie` est donné, la géométrie solaire y est lue
+    au lieu d'être calculée.'''
+    time = pd.DatetimeIndex(df.index)
+    if geometrie is not None:
+        zenith, r_a_dni = geometrie.lire(time, latitude, longitude, altitude)
+    else:
+        tz = pytz.country_timezones('FR')[0]
+        jour_annee = time.tz_convert(tz).dayofyear.to_numpy(dtype=float)
+        zenith = calcul_zenith_solaire(
+            jours_depuis_j2000(time), latitude, longitude, moteur=moteur)
+        r_a_dni = calcul_rayonnement_extraterrestre(jour_annee)
+
+    etp = noyau_etp(
+        df['temperature_2m'].to_numpy(dtype=float),
+        df['humidite_relative'].to_numpy(dtype=float),
+        df['vitesse_vent_10m'].to_numpy(dtype=float),
+        df['rayonnement_global'].to_numpy(dtype=float),
+        zenith, r_a_dni, altitude)
+
+    return pd.Series(etp, index=df.index)
+
+def calcul_etp_sites(temperature, humidite, vent, rayonnement, time,
+                     latitudes, longitudes, altitudes, moteur=MOTEUR,
+                     geometrie=None, max_workers=None):
+    '''Évapotranspiration potentielle (mm h-1) de plusieurs sites en un passage.
+
+    Les tableaux météorologiques sont de forme (site, heure) aux unités
+    de `calcul_etp`, `time` est l'indice des heures et les coordonnées
+    et altitudes sont données par site. Si `max_workers` est donné,
+    les sites sont répartis entre autant de processus.'''
+    if max_workers is not None:
+        return _calcul_etp_sites_processus(
+            temperature, humidite, vent, rayonnement, time,
+            latitudes, longitudes, altitudes, moteur=moteur,
+            geometrie=geometrie, max_workers=max_workers)
+
+    latitudes = np.asarray(latitudes, dtype=float)[:, None]
+    longitudes = np.asarray(longitudes, dtype=float)[:, None]
+    altitudes = np.asarray(altitudes, dtype=float)[:, None]
+    time = pd.DatetimeIndex(time)
+    if geometrie is not None:
+        geometrie_sites = [
+            geometrie.lire(time, latitude, longitude, altitude)
+            for latitude, longitude, altitude in zip(
+                latitudes[:, 0], longitudes[:, 0], altitudes[:, 0])]
+        zenith = np.array([zenith for zenith, _ in geometrie_sites])
+        r_a_dni = np.array([r_a_dni for _, r_a_dni in geometrie_sites])
+    else:
+        # Géométrie solaire de tous les sites par diffusion (site, heure)
+        tz = pytz.country_timezones('FR')[0]
+        jour_annee = time.tz_convert(tz).dayofyear.to_numpy(dtype=float)
+        zenith = calcul_zenith_solaire(
+            jours_depuis_j2000(time)[None, :], latitudes, longitudes,
+            moteur=moteur)
+        r_a_dni = calcul_rayonnement_extraterrestre(jour_annee)
+
+    return noyau_etp(
+        np.asarray(temperature, dtype=float), np.asarray(humidite, dtype=float),
+        np.asarray(vent, dtype=float), np.asarray(rayonnement, dtype=float),
+        zenith, r_a_dni, altitudes)
+
+def _calcul_etp_sites_processus(
+    temperature, humidite, vent, rayonnement, time,
+    latitudes, longitudes, altitudes, moteur=MOTEUR, geometrie=None,
+    max_workers=None):
+    '''Répartition des sites en blocs calculés par un groupe de processus.'''
+    blocs = np.array_split(np.arange(len(latitudes)), max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                calcul_etp_sites, temperature[bloc], humidite[bloc],
+                vent[bloc], rayonnement[bloc], time,
+                np.asarray(latitudes)[bloc], np.asarray(longitudes)[bloc],
+                np.asarray(altitudes)[bloc], moteur=moteur,
+                geometrie=geometrie)
+            for bloc in blocs if len(bloc) > 0]
+
+    return np.concatenate([future.result() for future in futures])
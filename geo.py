@@ -1,19 +1,120 @@
+import hashlib
 import numpy as np
+import os
 import pandas as pd
+from pathlib import Path
+import pickle
+from scipy import sparse
 from sklearn.neighbors import BallTree
+import threading
 
 
-# Rayon de la terre (km)
+# Rayon de la terre (km)
 RAYON_TERRE_KM = 6371.
 
+# Distance minimale (km) pour éviter un poids infini lorsqu'une station
+# est confondue avec la référence
+DISTANCE_MIN_KM = 1.e-3
+
+# Index spatiaux des stations déjà construits, par empreinte de liste
+_STATION_INDEXES = {}
+_VERROU_STATION_INDEXES = threading.Lock()
+
 def conversion_latlon_rad(df_liste_stations, latlon_labels):
     '''Conversion de degrés en radians pour toutes les stations.'''
-    df_latlon_rad = pd.DataFrame(index=df_liste_stations.index, dtype=float)
-    for latlon_label, latlon_series in df_liste_stations[latlon_labels].items():
-        df_latlon_rad.loc[:, f'{latlon_label}_rad'] = np.deg2rad(latlon_series)
+    df_latlon_rad = pd.DataFrame(
+        np.deg2rad(df_liste_stations[latlon_labels].to_numpy(dtype=float)),
+        index=df_liste_stations.index,
+        columns=[f'{latlon_label}_rad' for latlon_label in latlon_labels])
 
     return df_latlon_rad
 
+def empreinte_liste_stations(df_liste_stations, latlon_labels):
+    '''Empreinte du contenu (identifiants et coordonnées) d'une liste de stations.'''
+    hash_lignes = pd.util.hash_pandas_object(
+        df_liste_stations[latlon_labels], index=True)
+
+    return hashlib.sha256(hash_lignes.to_numpy().tobytes()).hexdigest()
+
+class StationIndex(object):
+    '''Index spatial réutilisable d'une liste de stations.
+
+    L'arbre haversine est construit une seule fois et interrogé
+    pour plusieurs points de référence à la fois.'''
+    def __init__(self, df_liste_stations, latlon_labels):
+        self.cle = empreinte_liste_stations(df_liste_stations, latlon_labels)
+        self.index = df_liste_stations.index
+        self.latlon_rad = conversion_latlon_rad(
+            df_liste_stations, latlon_labels).to_numpy()
+        self.arbre = BallTree(self.latlon_rad, metric='haversine')
+
+    @staticmethod
+    def get_filepath(dossier, cle):
+        return Path(dossier) / f"index_stations_{cle}.pkl"
+
+    def sauvegarder(self, dossier):
+        '''Sauvegarde de l'arbre et des coordonnées en radians, écrite dans
+        un fichier temporaire puis renommée pour ne jamais être tronquée.'''
+        Path(dossier).mkdir(parents=True, exist_ok=True)
+        filepath = self.get_filepath(dossier, self.cle)
+        filepath_tmp = filepath.with_name(
+            f"{filepath.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(filepath_tmp, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(filepath_tmp, filepath)
+
+    @classmethod
+    def charger(cls, dossier, cle):
+        '''Lecture d'un index sauvegardé, None s'il est absent ou illisible.'''
+        filepath = cls.get_filepath(dossier, cle)
+        if not filepath.exists():
+            return None
+        try:
+            with open(filepath, 'rb') as f:
+                return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+
+    def plus_proches(self, ref_latlon, nombre):
+        '''Distances (rad) et positions des `nombre` stations les plus proches
+        de chaque point de référence (tableaux de forme (points, nombre)).'''
+        ref_latlon_rad = np.deg2rad(np.atleast_2d(ref_latlon))
+
+        return self.arbre.query(ref_latlon_rad, k=nombre)
+
+    def dans_rayon(self, ref_latlon, rayon_km):
+        '''Distances (rad) et positions triées des stations à moins de `rayon_km`
+        de chaque point de référence (tableaux d'objets de longueur points).'''
+        ref_latlon_rad = np.deg2rad(np.atleast_2d(ref_latlon))
+        rayon_rad = rayon_km / RAYON_TERRE_KM
+        ind_arr, dist_rad_arr = self.arbre.query_radius(
+            ref_latlon_rad, rayon_rad,
+            count_only=False, return_distance=True, sort_results=True)
+
+        return dist_rad_arr, ind_arr
+
+def get_station_index(df_liste_stations, latlon_labels, dossier=None):
+    '''Index spatial d'une liste de stations, construit une fois par contenu.
+
+    L'index est gardé en mémoire et, si un `dossier` est donné,
+    sauvegardé sur disque pour être réutilisé d'une session à l'autre.
+    Lecture, construction et sauvegarde se font hors du verrou global.'''
+    cle = empreinte_liste_stations(df_liste_stations, latlon_labels)
+    with _VERROU_STATION_INDEXES:
+        station_index = _STATION_INDEXES.get(cle)
+    if station_index is not None:
+        return station_index
+
+    if dossier is not None:
+        station_index = StationIndex.charger(dossier, cle)
+    if station_index is None:
+        station_index = StationIndex(df_liste_stations, latlon_labels)
+        if dossier is not None:
+            station_index.sauvegarder(dossier)
+
+    with _VERROU_STATION_INDEXES:
+        return _STATION_INDEXES.setdefault(cle, station_index)
+
 def calcul_arbre(df_liste_stations, latlon_labels):
     '''Calcul de l'arbre des stations les plus proches.'''
     df_latlon_rad = conversion_latlon_rad(df_liste_stations, latlon_labels)
@@ -24,22 +125,19 @@ def calcul_arbre(df_liste_stations, latlon_labels):
 
 def selection_stations_plus_proches(
     df_liste_stations, ref_station_latlon, latlon_labels,
-    nombre=None, rayon_km=None):
+    nombre=None, rayon_km=None, dossier_index=None):
     
-    arbre = calcul_arbre(df_liste_stations, latlon_labels)
+    station_index = get_station_index(
+        df_liste_stations, latlon_labels, dossier=dossier_index)
 
-    # Conversion de degrés en radians pour la référence
-    ref_station_latlon_rad = np.deg2rad(ref_station_latlon)
-    
     if nombre is not None:
         # Identification d'un certain nombre de stations les plus proches
-        dist_rad_arr, ind_arr = arbre.query([ref_station_latlon_rad], k=nombre)
+        dist_rad_arr, ind_arr = station_index.plus_proches(
+            ref_station_latlon, nombre)
     elif rayon_km is not None:
-        # Identification des stations les plus proches dans un certain rayon
-        rayon_rad = rayon_km / RAYON_TERRE_KM
-        ind_arr, dist_rad_arr = arbre.query_radius(
-            [ref_station_latlon_rad], rayon_rad,
-            count_only=False, return_distance=True, sort_results=True)
+        # Identification des stations les plus proches dans un certain rayon
+        dist_rad_arr, ind_arr = station_index.dans_rayon(
+            ref_station_latlon, rayon_km)
 
     dist_rad, ind = dist_rad_arr[0], ind_arr[0]
 
@@ -52,16 +150,145 @@ def selection_stations_plus_proches(
     
     return df_liste_stations_nn
 
-def interpolation_inverse_distance_carre(df, s_dist_km):
+def calcul_poids_inverse_distance(dist_km, puissance=2, rayon_max_km=None):
+    '''Poids en inverse de la distance à une puissance, nuls au-delà du rayon maximal.'''
+    dist_km = np.asarray(dist_km, dtype=float)
+    poids = 1. / np.maximum(dist_km, DISTANCE_MIN_KM)**puissance
+    if rayon_max_km is not None:
+        poids = np.where(dist_km <= rayon_max_km, poids, 0.)
+
+    return poids
+
+def interpolation_cube_station(cube, poids):
+    '''Interpolation pondérée du cube (station, temps, variable) en un point,
+    en ignorant les valeurs manquantes. Renvoie un tableau (temps, variable).
+
+    La somme pondérée et la normalisation sont accumulées station par
+    station en un seul passage, sans copie du cube entier.'''
+    somme = np.zeros(cube.shape[1:])
+    normalisation = np.zeros(cube.shape[1:])
+    for poids_station, donnee_station in zip(poids, cube):
+        if poids_station == 0.:
+            continue
+        valide = ~np.isnan(donnee_station)
+        np.add(somme, poids_station * donnee_station, out=somme, where=valide)
+        np.add(normalisation, poids_station, out=normalisation, where=valide)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return somme / normalisation
+
+def interpolation_inverse_distance(
+    df, s_dist_km, puissance=2, rayon_max_km=None):
+    '''Interpolation des stations les plus proches pondérée par l'inverse de la distance à une puissance.'''
+    cube, time, variables = cube_donnee_stations(df, s_dist_km.index)
+    poids = calcul_poids_inverse_distance(
+        s_dist_km, puissance=puissance, rayon_max_km=rayon_max_km)
+
+    df_ref = pd.DataFrame(interpolation_cube_station(cube, poids),
+                          index=time, columns=variables)
+
+    return df_ref
+
+def interpolation_inverse_distance_carre(df, s_dist_km, rayon_max_km=None):
     '''Interpolation des stations les plus proches pondérée par l'inverse de la distance au carré.'''
-    # Calcul des poids à partir des distances
-    poids = 1. / s_dist_km**2
+    return interpolation_inverse_distance(
+        df, s_dist_km, puissance=2, rayon_max_km=rayon_max_km)
 
-    # Adaptation des dimensions des poids aux données météo
-    df_piv = df.unstack()
-    poids_piv = (df_piv + 1.e-6).mul(poids, axis='index') / (df_piv + 1.e-6)
+def selection_stations_plus_proches_multiples(
+    df_liste_stations, refs_latlon, latlon_labels,
+    nombre=None, rayon_km=None, dossier_index=None):
+    '''Sélection en une requête des stations les plus proches de plusieurs références.
 
-    # Interpolation
-    df_ref = ((df_piv * poids_piv).sum(0) / poids_piv.sum(0)).unstack().transpose()
-    
-    return df_ref
\ No newline at end of file
+    Renvoie la liste de l'union des stations sélectionnées, à télécharger
+    une seule fois, et la matrice creuse (références × stations de l'union)
+    des distances (km).'''
+    station_index = get_station_index(
+        df_liste_stations, latlon_labels, dossier=dossier_index)
+
+    if nombre is not None:
+        dist_rad_arr, ind_arr = station_index.plus_proches(refs_latlon, nombre)
+        nombres = np.full(len(ind_arr), nombre)
+        ind = ind_arr.ravel()
+        dist_rad = dist_rad_arr.ravel()
+    elif rayon_km is not None:
+        dist_rad_arr, ind_arr = station_index.dans_rayon(refs_latlon, rayon_km)
+        nombres = np.array([len(_) for _ in ind_arr])
+        ind = np.concatenate(ind_arr).astype(int)
+        dist_rad = np.concatenate(dist_rad_arr)
+
+    # Renumérotation des stations sélectionnées dans l'union
+    ind_union, ind_colonnes = np.unique(ind, return_inverse=True)
+    indptr = np.concatenate([[0], np.cumsum(nombres)])
+    matrice_distances_km = sparse.csr_array(
+        (dist_rad * RAYON_TERRE_KM, ind_colonnes, indptr),
+        shape=(len(nombres), len(ind_union)))
+
+    df_liste_stations_union = df_liste_stations.iloc[ind_union]
+
+    return df_liste_stations_union, matrice_distances_km
+
+def matrice_poids_inverse_distance(
+    matrice_distances_km, puissance=2, rayon_max_km=None):
+    '''Matrice creuse des poids en inverse de la distance à une puissance.'''
+    matrice_poids = matrice_distances_km.astype(float, copy=True)
+    matrice_poids.data = calcul_poids_inverse_distance(
+        matrice_poids.data, puissance=puissance, rayon_max_km=rayon_max_km)
+
+    return matrice_poids
+
+def cube_donnee_stations(df, id_stations, variables=None):
+    '''Tableau dense (station, temps, variable) de la donnée indexée par
+    (station, temps), les valeurs manquantes valant NaN.'''
+    if variables is None:
+        variables = list(df.select_dtypes('number').columns)
+
+    # Positions des lignes dans le cube obtenues à partir des codes de
+    # l'indice, sans matérialiser les valeurs des stations et des temps
+    levels_stations, levels_time = df.index.levels[:2]
+    codes_stations, codes_time = df.index.codes[:2]
+    time = levels_time[np.unique(codes_time)].sort_values()
+    i_station = pd.Index(id_stations).get_indexer(
+        levels_stations)[codes_stations]
+    i_time = time.get_indexer(levels_time)[codes_time]
+
+    cube = np.full((len(id_stations), len(time), len(variables)), np.nan)
+    donnee = df[variables].to_numpy(dtype=float)
+    selection = i_station >= 0
+    if selection.all():
+        cube[i_station, i_time] = donnee
+    else:
+        cube[i_station[selection], i_time[selection]] = donnee[selection]
+
+    return cube, time, variables
+
+def interpolation_cube(cube, matrice_poids):
+    '''Interpolation pondérée du cube (station, temps, variable) pour chaque
+    référence, en ignorant les valeurs manquantes. Renvoie un tableau
+    (référence, temps, variable).'''
+    nombre_stations, nombre_temps, nombre_variables = cube.shape
+    valide = ~np.isnan(cube)
+    shape_plat = (nombre_stations, nombre_temps * nombre_variables)
+    donnee = np.where(valide, cube, 0.).reshape(shape_plat)
+    valide = valide.reshape(shape_plat).astype(float)
+
+    # Somme pondérée et normalisation par les poids des valeurs présentes
+    somme = matrice_poids @ donnee
+    normalisation = matrice_poids @ valide
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cube_refs = somme / normalisation
+
+    return cube_refs.reshape(
+        matrice_poids.shape[0], nombre_temps, nombre_variables)
+
+def interpolation_inverse_distance_carre_multiples(
+    df, df_liste_stations_union, matrice_distances_km, variables=None):
+    '''Interpolation pondérée par l'inverse de la distance au carré pour
+    plusieurs références en un seul produit matriciel creux.
+
+    Renvoie le tableau (référence, temps, variable), l'indice temporel
+    et les variables.'''
+    cube, time, variables = cube_donnee_stations(
+        df, df_liste_stations_union.index, variables=variables)
+    matrice_poids = matrice_poids_inverse_distance(matrice_distances_km)
+
+    return interpolation_cube(cube, matrice_poids), time, variables
@@ -0,0 +1,255 @@
+'''Besoin d'irrigation de parcelles pour les dernières 24 h, sans navigateur.
+
+Enchaîne, pour toutes les parcelles à la fois, les étapes de l'application :
+liste des stations, sélection des stations voisines, paquets des
+départements, interpolation, ETP et bilan hydrique.
+
+Utilisation : `python irrigation_parcelles.py parcelles.csv recommandations.csv`
+(fichiers CSV ou Parquet, voir `python irrigation_parcelles.py --help`).
+L'Application ID Météo-France est lu dans la variable d'environnement
+`METEOFRANCE_APPLICATION_ID` s'il n'est pas donné en option.
+'''
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import bilan
+import etp
+import geo
+import meteofrance
+import stockage
+
+# Météo-France API
+METEOFRANCE_API = 'DPPaquetObs'
+
+# Fréquence des données climatiques
+METEOFRANCE_FREQUENCE = 'horaire'
+
+# Variable d'environnement donnant l'Application ID Météo-France
+VARIABLE_APPLICATION_ID = 'METEOFRANCE_APPLICATION_ID'
+
+# Colonnes obligatoires du fichier des parcelles (indexé par nom)
+NOM_PARCELLE = 'nom'
+COLONNES_PARCELLES = ['latitude', 'longitude', 'altitude',
+                      'culture', 'stade', 'texture']
+
+# Paramètres du bilan par défaut (ceux de l'application), remplacés
+# par les colonnes de même nom du fichier des parcelles
+PARAMETRES_BILAN = {
+    'fraction_cailloux': 0.1,
+    'fraction_ru_remplie': 1.,
+    'ru_vers_rfu': 0.67,
+    'seuil_irrigation': 0.1,
+    'hauteur_vers_duree_irrigation': 10
+}
+
+# Distance maximale (km) des stations aux parcelles
+RAYON_KM = 30.
+
+# Variables utilisées pour le calcul de l'ETP et du bilan hydrique
+# et leur agrégation journalière
+VARIABLES_POUR_CALCULS = dict(
+    **etp.VARIABLES_CALCUL_ETP,
+    **bilan.VARIABLES_CALCUL_BILAN)
+VARIABLES_POUR_CALCULS_SANS_ETP = VARIABLES_POUR_CALCULS.copy()
+del VARIABLES_POUR_CALCULS_SANS_ETP['etp']
+
+def lire_parcelles(filepath):
+    '''Parcelles indexées par nom, complétées des paramètres du bilan par défaut.'''
+    df_parcelles = stockage.lire(filepath, index_col=NOM_PARCELLE)
+    manquantes = [colonne for colonne in COLONNES_PARCELLES
+                  if colonne not in df_parcelles]
+    if len(manquantes) > 0:
+        raise ValueError(f"Colonnes absentes du fichier des parcelles: {manquantes}. "
+                         f"Les colonnes obligatoires sont: "
+                         f"{[NOM_PARCELLE] + COLONNES_PARCELLES}")
+
+    # Cultures, stades et textures connus du bilan, vérifiés avant tout
+    # téléchargement pour ne pas interrompre le calcul de toutes les parcelles
+    kc = bilan.get_kc()
+    cultures = [culture for culture in kc
+                if culture in bilan.PROFONDEUR_ENRACINEMENT_TYPIQUE]
+    culture_valide = df_parcelles['culture'].isin(cultures)
+    stade_valide = pd.Series(
+        [(culture in kc) and (stade in kc[culture]) for culture, stade in
+         zip(df_parcelles['culture'], df_parcelles['stade'])],
+        index=df_parcelles.index)
+    invalides = {
+        'culture': ~culture_valide,
+        'stade': culture_valide & ~stade_valide,
+        'texture': ~df_parcelles['texture'].isin(list(bilan.RU_PAR_CM_DE_TF))}
+    erreurs = [f"{nom} ({colonne}: {valeur})"
+               for colonne, invalide in invalides.items()
+               for nom, valeur in df_parcelles.loc[invalide, colonne].items()]
+    if len(erreurs) > 0:
+        raise ValueError(f"Choix invalide pour les parcelles: {erreurs}. "
+                         f"Les choix possibles sont: cultures {cultures}, "
+                         f"stades de la culture dans `bilan.KC`, "
+                         f"textures {list(bilan.RU_PAR_CM_DE_TF)}")
+
+    for parametre, valeur in PARAMETRES_BILAN.items():
+        if parametre not in df_parcelles:
+            df_parcelles[parametre] = valeur
+        else:
+            df_parcelles[parametre] = df_parcelles[parametre].fillna(valeur)
+
+    return df_parcelles
+
+def calcul_meteo_parcelles(
+    client, df_parcelles, rayon_km=RAYON_KM,
+    max_workers=meteofrance.MAX_REQUETES_SIMULTANEES, processus=None):
+    '''Météo journalière des dernières 24 h (unités SI, ETP comprise) de chaque parcelle.
+
+    Les stations voisines de toutes les parcelles sont sélectionnées en une
+    requête et téléchargées une seule fois, par paquets de départements
+    (`max_workers` requêtes simultanées). L'ETP est calculée pour toutes
+    les parcelles à la fois, réparties entre `processus` processus si donné.
+    La météo des parcelles sans station voisine (ou sans donnée) est inconnue.'''
+    df_liste_stations = meteofrance.lire_liste_stations(
+        client, index_col=client.id_station_label)
+    df_liste_stations_union, matrice_distances_km = (
+        geo.selection_stations_plus_proches_multiples(
+            df_liste_stations,
+            df_parcelles[['latitude', 'longitude']].to_numpy(dtype=float),
+            client.latlon_labels, rayon_km=rayon_km,
+            dossier_index=meteofrance.DATA_DIR / client.api))
+
+    df_meteo_parcelles = pd.DataFrame(
+        np.nan, index=df_parcelles.index, columns=list(VARIABLES_POUR_CALCULS))
+    df_meteo_parcelles['nombre_stations'] = np.diff(matrice_distances_km.indptr)
+    df_meteo_parcelles['periode'] = None
+    if len(df_liste_stations_union) == 0:
+        # Aucune station à moins de `rayon_km` des parcelles
+        return df_meteo_parcelles
+
+    labels = client.variables_labels[METEOFRANCE_FREQUENCE]
+    variables = list(VARIABLES_POUR_CALCULS_SANS_ETP)
+    df_meteo = meteofrance.compiler_donnee_des_departements(
+        client, df_liste_stations_union, frequence=METEOFRANCE_FREQUENCE,
+        max_workers=max_workers)
+    if len(df_meteo) == 0:
+        # Aucune donnée des stations voisines pour les dernières 24 h
+        return df_meteo_parcelles
+
+    # Tableau (parcelle, heure, variable) interpolé et converti en unités SI
+    cube_parcelles, time, _ = geo.interpolation_inverse_distance_carre_multiples(
+        df_meteo, df_liste_stations_union, matrice_distances_km,
+        variables=[labels[variable] for variable in variables])
+    meteo_parcelles = {
+        variable: client.variables_conversion_unites[variable](
+            cube_parcelles[:, :, i])
+        for i, variable in enumerate(variables)}
+
+    meteo_parcelles['etp'] = etp.calcul_etp_sites(
+        meteo_parcelles['temperature_2m'], meteo_parcelles['humidite_relative'],
+        meteo_parcelles['vitesse_vent_10m'], meteo_parcelles['rayonnement_global'],
+        time, df_parcelles['latitude'], df_parcelles['longitude'],
+        df_parcelles['altitude'], geometrie=etp.GEOMETRIE_SOLAIRE,
+        max_workers=processus)
+
+    # Calcul des valeurs journalières des variables météo, inconnues si
+    # aucune heure n'a de donnée (la somme d'heures sans donnée n'est pas nulle)
+    for variable, agregation in VARIABLES_POUR_CALCULS.items():
+        df_variable = pd.DataFrame(
+            meteo_parcelles[variable], index=df_parcelles.index)
+        df_meteo_parcelles[variable] = getattr(df_variable, agregation)(
+            axis=1).where(df_variable.notna().any(axis=1))
+
+    # Météo inconnue pour les parcelles sans station voisine
+    df_meteo_parcelles.loc[df_meteo_parcelles['nombre_stations'] == 0,
+                           list(VARIABLES_POUR_CALCULS)] = np.nan
+    df_meteo_parcelles['periode'] = f"{time.min()} - {time.max()}"
+
+    return df_meteo_parcelles
+
+def calcul_bilan_parcelles(df_parcelles, df_meteo_parcelles):
+    '''Bilan hydrique et besoin d'irrigation de chaque parcelle,
+    inconnus (NA) pour les parcelles dont la météo est inconnue.'''
+    l_bilan = []
+    for nom, parcelle in df_parcelles.iterrows():
+        s_bilan = bilan.calcul_bilan(
+            df_meteo_parcelles.loc[nom],
+            parcelle['texture'], parcelle['fraction_cailloux'],
+            parcelle['culture'], parcelle['stade'],
+            parcelle['fraction_ru_remplie'], parcelle['ru_vers_rfu'],
+            seuil_irrigation=parcelle['seuil_irrigation'],
+            hauteur_vers_duree_irrigation=parcelle['hauteur_vers_duree_irrigation'])
+        l_bilan.append(s_bilan.rename(nom))
+    df_bilan = pd.DataFrame(l_bilan).infer_objects()
+    df_bilan.index.name = df_parcelles.index.name
+
+    # Sans météo, le bilan compare NaN au seuil et conclurait à tort
+    # qu'aucune irrigation n'est nécessaire
+    sans_meteo = df_meteo_parcelles[
+        list(bilan.VARIABLES_CALCUL_BILAN)].isna().any(axis=1)
+    df_bilan['irrigation'] = df_bilan['irrigation'].astype('boolean')
+    df_bilan.loc[sans_meteo, ['irrigation', 'duree_irrigation',
+                              'besoin_irrigation']] = pd.NA
+
+    return df_bilan
+
+def recommandations_irrigation(
+    client, df_parcelles, rayon_km=RAYON_KM,
+    max_workers=meteofrance.MAX_REQUETES_SIMULTANEES, processus=None):
+    '''Recommandations d'irrigation des parcelles : description de la parcelle,
+    météo journalière des dernières 24 h et bilan hydrique.'''
+    df_meteo_parcelles = calcul_meteo_parcelles(
+        client, df_parcelles, rayon_km=rayon_km, max_workers=max_workers,
+        processus=processus)
+    df_bilan = calcul_bilan_parcelles(df_parcelles, df_meteo_parcelles)
+
+    return pd.concat([
+        df_parcelles[COLONNES_PARCELLES],
+        df_meteo_parcelles[['periode', 'nombre_stations']],
+        df_bilan[['irrigation', 'duree_irrigation', 'besoin_irrigation']],
+        df_meteo_parcelles[list(VARIABLES_POUR_CALCULS)].add_prefix('meteo_'),
+        df_bilan.drop(columns=['irrigation', 'duree_irrigation',
+                               'besoin_irrigation', 'etp', 'precipitation'])
+    ], axis=1)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Besoin d'irrigation des parcelles pour les dernières 24 h.")
+    parser.add_argument(
+        'parcelles', help="Fichier CSV ou Parquet des parcelles (colonnes "
+        f"{', '.join([NOM_PARCELLE] + COLONNES_PARCELLES)} et, en option, "
+        f"{', '.join(PARAMETRES_BILAN)})")
+    parser.add_argument(
+        'recommandations', help="Fichier CSV ou Parquet des recommandations")
+    parser.add_argument(
+        '--application-id', default=os.environ.get(VARIABLE_APPLICATION_ID),
+        help=f"Application ID Météo-France (par défaut ${VARIABLE_APPLICATION_ID})")
+    parser.add_argument(
+        '--rayon-km', type=float, default=RAYON_KM,
+        help="Distance maximale des stations aux parcelles (km)")
+    parser.add_argument(
+        '--max-workers', type=int, default=meteofrance.MAX_REQUETES_SIMULTANEES,
+        help="Nombre de requêtes simultanées à l'API")
+    parser.add_argument(
+        '--processus', type=int, default=None,
+        help="Nombre de processus pour le calcul de l'ETP (aucun par défaut)")
+    args = parser.parse_args(args)
+    if not args.application_id:
+        parser.error("Application ID Météo-France absent (option --application-id "
+                     f"ou variable d'environnement {VARIABLE_APPLICATION_ID})")
+
+    client = meteofrance.Client(METEOFRANCE_API,
+                                application_id=args.application_id)
+    df_parcelles = lire_parcelles(args.parcelles)
+    df_recommandations = recommandations_irrigation(
+        client, df_parcelles, rayon_km=args.rayon_km,
+        max_workers=args.max_workers, processus=args.processus)
+    stockage.ecrire(df_recommandations, args.recommandations)
+
+    sans_station = (df_recommandations['nombre_stations'] == 0).sum()
+    print(f"{len(df_recommandations):d} parcelle(s), "
+          f"{df_recommandations['irrigation'].sum():d} à irriguer, "
+          f"{sans_station:d} sans station à moins de {args.rayon_km:g} km")
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
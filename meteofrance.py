@@ -1,12 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+import io
 from io import StringIO
 import json
 import numpy as np
 import pandas as pd
 from pathlib import Path
+import random
 import requests
+import threading
 import time
 import warnings
 
+import cache as cache_reponses
+import stockage
+
 # Host
 HOST = 'https://public-api.meteofrance.fr'
 DOMAIN = 'public'
@@ -145,10 +154,103 @@ TZ = 'UTC'
 # Dossier des données
 DATA_DIR = Path('data')
 
+# Nombre maximal de requêtes simultanées vers l'API
+MAX_REQUETES_SIMULTANEES = 8
+
+# Nombre de lignes lues à la fois dans les réponses CSV filtrées par station
+TAILLE_BLOC_CSV = 10000
+
+# Taille (octets) des blocs lus dans le corps des réponses en flux
+TAILLE_BLOC_FLUX = 1024**2
+
+# Quota de requêtes par minute de l'API Météo-France
+REQUETES_PAR_MINUTE = 50
+
+# Nombre de requêtes pouvant partir en rafale, pris sur le quota
+# pour que la rafale et le remplissage du seau restent dans le quota
+RAFALE_REQUETES = 5
+
+# Statuts des réponses donnant lieu à une nouvelle tentative
+STATUTS_A_REESSAYER = (429, 500, 502, 503, 504)
+
+# Nombre maximal de nouvelles tentatives pour ces statuts
+MAX_TENTATIVES = 5
+
+# Délais de base et maximal (s) de l'attente exponentielle entre tentatives
+DELAI_BASE_TENTATIVES = 1.
+DELAI_MAX_TENTATIVES = 60.
+
+# Cache sur disque des réponses de l'API partagé par défaut entre clients
+CACHE_REPONSES = cache_reponses.CacheReponses(DATA_DIR / 'cache')
+
+# Cache en mémoire des DataFrames lus (liste des stations, paquets des
+# départements) partagé par les clients du processus (sessions Panel...)
+CACHE_FRAMES = cache_reponses.CacheMemoire()
+
+class SeauJetons(object):
+    '''Seau à jetons limitant le débit de requêtes partagé entre threads.
+
+    Le seau se remplit au taux du quota diminué de sa capacité : sur toute
+    minute, la rafale initiale et le remplissage ne dépassent pas le quota.'''
+    def __init__(self, requetes_par_minute, capacite=RAFALE_REQUETES):
+        self.capacite = min(capacite, requetes_par_minute - 1)
+        self.taux = (requetes_par_minute - self.capacite) / 60.
+        self._jetons = float(self.capacite)
+        self._derniere_maj = time.monotonic()
+        self._reprise = 0.
+        self._verrou = threading.Lock()
+
+    def acquerir(self):
+        '''Réservation d'un jeton et attente jusqu'à sa disponibilité.'''
+        with self._verrou:
+            maintenant = time.monotonic()
+            self._jetons = min(self.capacite, self._jetons + (
+                maintenant - self._derniere_maj) * self.taux)
+            self._derniere_maj = maintenant
+
+            # Le jeton est réservé tout de suite, quitte à rendre le seau
+            # négatif, pour que les threads suivants attendent leur tour
+            self._jetons -= 1.
+            attente = max(-self._jetons / self.taux,
+                          self._reprise - maintenant, 0.)
+        time.sleep(attente)
+
+    def suspendre(self, delai):
+        '''Suspension de toutes les requêtes pendant un délai (s).'''
+        with self._verrou:
+            self._reprise = max(self._reprise, time.monotonic() + delai)
+
+# Seaux à jetons par Application ID, le quota étant celui de l'application
+# quel que soit le nombre de clients (sessions Panel...)
+SEAUX_JETONS = {}
+_VERROU_SEAUX_JETONS = threading.Lock()
+
+def get_seau_jetons(application_id, requetes_par_minute=REQUETES_PAR_MINUTE):
+    '''Seau à jetons partagé par tous les clients de cet Application ID.'''
+    with _VERROU_SEAUX_JETONS:
+        if application_id not in SEAUX_JETONS:
+            SEAUX_JETONS[application_id] = SeauJetons(requetes_par_minute)
+        return SEAUX_JETONS[application_id]
+
 class Client(object):
-    def __init__(self, api, application_id=None):
+    def __init__(self, api, application_id=None,
+                 requetes_par_minute=REQUETES_PAR_MINUTE,
+                 max_tentatives=MAX_TENTATIVES, cache=True):
         self.session = requests.Session()
+        # Connexions conservées pour toutes les requêtes simultanées
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=MAX_REQUETES_SIMULTANEES,
+            pool_maxsize=MAX_REQUETES_SIMULTANEES)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self._application_id = application_id
+        self._verrou_token = threading.Lock()
+        self.requetes_par_minute = requetes_par_minute
+        self.max_tentatives = max_tentatives
+        if cache is True:
+            cache = CACHE_REPONSES
+        self.cache = cache or None
+        self.cache_frames = None if self.cache is None else CACHE_FRAMES
         if api not in AVAILABLE_APIS:
             raise ValueError(f"Choix invalide: {api}. "
                              f"Les choix possibles sont: {AVAILABLE_APIS}")
@@ -173,39 +275,81 @@ class Client(object):
     @application_id.setter
     def application_id(self, value):
         self._application_id = value
+
+    @property
+    def seau_jetons(self):
+        '''Seau à jetons de l'Application ID, None sans limite de débit.'''
+        if self.requetes_par_minute is None:
+            return None
+        return get_seau_jetons(self.application_id, self.requetes_par_minute)
         
     def request(self, method, url, **kwargs):
         # First request will always need to obtain a token first
-        if 'Authorization' not in self.session.headers:
-            self.obtain_token()
+        # (only once, even if several threads share the client)
+        with self._verrou_token:
+            if 'Authorization' not in self.session.headers:
+                self.obtain_token()
             
-        # Optimistically attempt to dispatch reqest
+        for tentative in range(self.max_tentatives + 1):
+            # Optimistically attempt to dispatch reqest
+            autorisation = self.session.headers.get('Authorization')
+            response = self.dispatch(method, url, **kwargs)
+
+            if self.token_has_expired(response):
+                # We got an 'Access token expired' response => refresh token
+                # (once, unless another thread already refreshed it)
+                response.close()
+                with self._verrou_token:
+                    if self.session.headers.get('Authorization') == autorisation:
+                        self.obtain_token()
+
+                # Re-dispatch the request that previously failed
+                response = self.dispatch(method, url, **kwargs)
+
+            # Quota dépassé ou erreur du serveur => nouvelle tentative
+            if ((response.status_code not in STATUTS_A_REESSAYER) or
+                (tentative == self.max_tentatives)):
+                break
+            delai = self.delai_avant_nouvelle_tentative(response, tentative)
+            # Réponse abandonnée, libérée même si elle est lue en flux
+            response.close()
+            time.sleep(delai)
+
+        response.raise_for_status()
+
+        return response
+
+    def dispatch(self, method, url, **kwargs):
+        '''Envoi d'une requête dans la limite du quota de requêtes.'''
+        if self.seau_jetons is not None:
+            self.seau_jetons.acquerir()
+
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             response = self.session.request(method, url, **kwargs)
 
-        if self.token_has_expired(response):
-            # We got an 'Access token expired' response => refresh token
-            self.obtain_token()
+        return response
 
-            # Re-dispatch the request that previously failed
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                response = self.session.request(method, url, **kwargs)
+    def delai_avant_nouvelle_tentative(self, response, tentative):
+        '''Délai (s) donné par Retry-After ou attente exponentielle aléatoire.'''
+        delai = get_retry_after(response)
+        if delai is not None:
+            # Le serveur impose une pause valable pour toutes les requêtes
+            if self.seau_jetons is not None:
+                self.seau_jetons.suspendre(delai)
+            return delai
 
-        response.raise_for_status()
-
-        return response
+        return random.uniform(0., min(
+            DELAI_MAX_TENTATIVES, DELAI_BASE_TENTATIVES * 2**tentative))
 
     def token_has_expired(self, response):
         status = response.status_code
-        content_type = response.headers['Content-Type']
-        repJson = response.text
+        content_type = response.headers.get('Content-Type', '')
 
         if status == 401 and 'application/json' in content_type:
-            repJson = response.text
+            repJson = response.json()
             
-            if 'Invalid JWT token' in repJson['description']:
+            if 'Invalid JWT token' in repJson.get('description', ''):
                 return True
 
         return False
@@ -223,6 +367,26 @@ class Client(object):
         # Update session with fresh token
         self.session.headers.update({'Authorization': 'Bearer %s' % token})
 
+def get_retry_after(response):
+    '''Délai (s) demandé par l'en-tête Retry-After, None s'il est absent.'''
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        delai = float(retry_after)
+    except ValueError:
+        # Retry-After donné sous forme de date HTTP
+        try:
+            date = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            # Date HTTP en -0000 : UTC
+            date = date.replace(tzinfo=timezone.utc)
+        delai = (date - pd.Timestamp.now(tz=TZ)).total_seconds()
+
+    return max(0., delai)
+
 def response_text_to_frame(client, response, **kwargs):
     try:
         
@@ -233,28 +397,143 @@ def response_text_to_frame(client, response, **kwargs):
     
     return df
 
-def demande(client, section, params=None, frequence=None, verify=False):
-    '''Demande de la liste des stations.'''
+class FluxReponse(io.RawIOBase):
+    '''Fichier en lecture seule sur le corps d'une réponse lu par blocs.'''
+    def __init__(self, response, chunk_size=TAILLE_BLOC_FLUX):
+        self._blocs = response.iter_content(chunk_size=chunk_size)
+        self._reste = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._reste) == 0:
+            try:
+                self._reste = memoryview(next(self._blocs))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._reste))
+        b[:n] = self._reste[:n]
+        self._reste = self._reste[n:]
+
+        return n
+
+def response_flux_to_frame(client, response, frequence=None, **kwargs):
+    '''Lecture en flux d'une réponse CSV, sans décoder tout son corps.
+
+    Si la fréquence est donnée, seules les colonnes des stations, du temps
+    et des variables de `VARIABLES_LABELS` sont lues, les variables en
+    simple précision et les identifiants des stations en catégories
+    (sauf s'ils forment l'indice, déjà codé par niveau).'''
+    if frequence is not None:
+        variables = list(client.variables_labels[frequence].values())
+        colonnes = [client.id_station_donnee_label, client.time_label] + variables
+        dtype = {variable: np.float32 for variable in variables}
+        if client.id_station_donnee_label not in kwargs.get('index_col', []):
+            dtype[client.id_station_donnee_label] = 'category'
+        kwargs.setdefault('usecols', lambda colonne: colonne in colonnes)
+        kwargs.setdefault('dtype', dtype)
+
+    try:
+        df = pd.read_csv(io.BufferedReader(FluxReponse(response)), sep=';',
+                         encoding=response.encoding or 'utf-8', **kwargs)
+    finally:
+        response.close()
+
+    return df
+
+def response_flux_to_frame_stations(
+    client, response, id_stations, chunksize=TAILLE_BLOC_CSV, **kwargs):
+    '''Lecture en flux et par blocs d'une réponse CSV en ne gardant que
+    les lignes des stations demandées, sans décoder tout son corps.
+
+    Si aucune ligne ne correspond, le DataFrame renvoyé est vide
+    mais a les colonnes de la réponse.'''
+    l_df = []
+    df_vide = pd.DataFrame(
+        columns=[client.id_station_donnee_label, client.time_label])
+    try:
+        with pd.read_csv(io.BufferedReader(FluxReponse(response)), sep=';',
+                         encoding=response.encoding or 'utf-8',
+                         chunksize=chunksize, **kwargs) as blocs:
+            for bloc in blocs:
+                bloc = bloc[bloc[client.id_station_donnee_label].isin(id_stations)]
+                if len(bloc) > 0:
+                    l_df.append(bloc)
+                elif len(l_df) == 0:
+                    df_vide = bloc
+    except pd.errors.EmptyDataError:
+        # Réponse sans en-tête
+        pass
+    finally:
+        response.close()
+
+    if len(l_df) == 0:
+        return df_vide
+
+    return pd.concat(l_df)
+
+def demande(client, section, params=None, frequence=None, verify=False,
+            stream=False):
+    '''Demande à l'API, servie par le cache du client si possible.
+
+    Si `stream` est vrai, le corps de la réponse est lu en flux.'''
+    if client.cache is None:
+        return envoyer_demande(client, section, params=params,
+                               frequence=frequence, verify=verify,
+                               stream=stream)
+
+    # Les demandes simultanées identiques attendent la première
+    cle = client.cache.cle(client.api, section, params, frequence)
+    with client.cache.verrou_demande(cle):
+        response = client.cache.lire(cle, flux=stream)
+        if response is None:
+            response = envoyer_demande(client, section, params=params,
+                                       frequence=frequence, verify=verify,
+                                       stream=stream)
+            client.cache.ecrire(cle, section, response)
+
+    return response
+
+def envoyer_demande(client, section, params=None, frequence=None,
+                    verify=False, stream=False):
+    '''Envoi d'une demande à l'API, sans passer par le cache.'''
     url = f"{HOST}/{DOMAIN}/{client.api}/{VERSION}/{section}"
 
     if frequence is not None:
         url += f'/{frequence}'
     
-    response = client.request(
-        'GET', url, params=params, verify=verify)
+    return client.request(
+        'GET', url, params=params, verify=verify, stream=stream)
 
-    return response
+def lire_liste_stations(client, **kwargs):
+    '''Liste des stations de l'API.
+
+    Avec le cache, elle est lue une seule fois pour tous les clients
+    pendant sa durée de vie et ne doit pas être modifiée sur place.'''
+    def lire():
+        response = demande(client, SECTION_LISTE_STATIONS)
+        return response_text_to_frame(client, response, **kwargs)
+
+    if client.cache_frames is None:
+        return lire()
+
+    cle = (client.api, SECTION_LISTE_STATIONS, json.dumps(kwargs, sort_keys=True))
+
+    return client.cache_frames.obtenir(
+        cle, lire, duree_vie=client.cache.durees_vie.get(SECTION_LISTE_STATIONS))
 
 def liste_id_stations_vers_liste_id_departements(df_liste_stations):
     return np.unique([_ // 1000000 for _ in df_liste_stations.index])
 
-def get_filepath_liste_stations(client, frequence=None, id_departement=None):
+def get_filepath_liste_stations(
+    client, frequence=None, id_departement=None, fmt=None):
     filename = f"liste_stations_{client.api}"
     if frequence is not None:
         filename += f"_{frequence}"
     if id_departement is not None:
         filename += f"_{id_departement:d}"
-    filename += ".csv"
+    filename += stockage.get_suffixe(fmt)
     parent = DATA_DIR / client.api
     parent.mkdir(parents=True, exist_ok=True)
     filepath = parent / filename
@@ -263,9 +542,9 @@ def get_filepath_liste_stations(client, frequence=None, id_departement=None):
 
 def get_filepath_liste_stations_nn(
     client, ref_station_name, df_liste_stations,
-    frequence=None, id_departement=None):
+    frequence=None, id_departement=None, fmt=None):
     filepath = get_filepath_liste_stations(
-        client, frequence=frequence, id_departement=id_departement)
+        client, frequence=frequence, id_departement=id_departement, fmt=fmt)
     str_ref_station_name = ref_station_name.lower().replace(' ', '')
     nn_nombre = len(df_liste_stations)
     str_nn = f"nn{nn_nombre:d}"
@@ -277,7 +556,7 @@ def get_filepath_liste_stations_nn(
 def get_filepath_donnee_periode(
     client, ref_station_name, df_liste_stations=None,
     date_deb_periode=None, date_fin_periode=None,
-    frequence=None, ref=False, nn_nombre=None):
+    frequence=None, ref=False, nn_nombre=None, fmt=None):
     filename = f"donnees_{client.api}"
     if frequence is not None:
         filename += f"_{frequence}"
@@ -299,16 +578,16 @@ def get_filepath_donnee_periode(
     
     filename += (f"_{str_ref_station_name}_{str_nn}"
                  f"{str_date_deb_periode}{str_date_fin_periode}"
-                 f"_{str_station}.csv")
+                 f"_{str_station}{stockage.get_suffixe(fmt)}")
     parent = DATA_DIR / client.api
     parent.mkdir(parents=True, exist_ok=True)
     filepath = parent / filename
     
     return filepath
 
-def compiler_donnee_des_stations_date(
+def iterer_donnee_des_stations_date(
     client, df_liste_stations, date, frequence=None):
-    df = pd.DataFrame(dtype=float)
+    '''Donnée de chaque station de la liste à une date, station par station.'''
     for id_station in df_liste_stations.index:
         # Paramètres définissant la station, la date et le format des données
         params = {'id_station': id_station, 'date': date, 'format': FMT}
@@ -318,109 +597,243 @@ def compiler_donnee_des_stations_date(
         response = demande(client, section, params=params, frequence=frequence)
 
         # DataFrame de la station
-        s_station = response_text_to_frame(response).iloc[0]
+        s_station = response_text_to_frame(client, response).iloc[0]
         df_station = s_station.to_frame(id_station).transpose()
 
-        # Compilation
-        df = pd.concat([df, df_station])
-        
+        yield df_station
+
+def compiler_donnee_des_stations_date(
+    client, df_liste_stations, date, frequence=None):
+    '''Donnée des stations à une date, concaténée en une seule fois.'''
+    df = pd.concat(list(iterer_donnee_des_stations_date(
+        client, df_liste_stations, date, frequence=frequence)))
+
     return df
 
-def compiler_commandes_des_stations_periode(
-    client, df_liste_stations, date_deb_periode, date_fin_periode,
-    frequence=None):
+def commander_station_periode(
+    client, id_station, date_deb_periode, date_fin_periode, frequence=None):
+    '''Commande de la donnée d'une station pour une période.'''
+    # Paramètres définissant la station et la période
     params = {
+        'id-station': id_station,
         'date-deb-periode': date_deb_periode,
         'date-fin-periode': date_fin_periode
     }
-    id_commandes = {}
-    for id_station in df_liste_stations.index:
-        # Paramètres définissant la station, la date et le format des données
-        params['id-station'] = id_station,
-        
-        # Requête pour la station
-        section = 'commande-station'
-        response = demande(client, section, params=params, frequence=frequence)
 
-        # Récupération de l'identifiant de la commande pour la station
-        id_commandes[id_station] = (
-            response.json()['elaboreProduitAvecDemandeResponse']['return'])
+    # Requête pour la station
+    section = 'commande-station'
+    response = demande(client, section, params=params, frequence=frequence)
+
+    # Récupération de l'identifiant de la commande pour la station
+    id_cmde = response.json()['elaboreProduitAvecDemandeResponse']['return']
+
+    # Le fichier de la commande est mis en cache sous la demande de la
+    # station et de la période plutôt que sous l'identifiant de la commande,
+    # pour être réutilisé par les commandes suivantes identiques
+    if client.cache is not None:
+        client.cache.associer(
+            client.cache.cle(client.api, 'commande', {'id-cmde': id_cmde},
+                             'fichier'),
+            client.cache.cle(client.api, 'commande', params, 'fichier'))
+
+    return id_cmde
+
+def compiler_commandes_des_stations_periode(
+    client, df_liste_stations, date_deb_periode, date_fin_periode,
+    frequence=None, max_workers=MAX_REQUETES_SIMULTANEES):
+    '''Commande simultanée de la donnée des stations pour une période.'''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            id_station: executor.submit(
+                commander_station_periode, client, id_station,
+                date_deb_periode, date_fin_periode, frequence=frequence)
+            for id_station in df_liste_stations.index}
+
+    id_commandes = {id_station: future.result()
+                    for id_station, future in futures.items()}
 
     return id_commandes
 
-def compiler_telechargement_des_stations_periode(
+def telecharger_commande(
+    client, id_cmde, frequence=None, read_csv_kwargs={},
+    desired_status_code=201):
+    '''Téléchargement d'une commande si elle est prête, None sinon.
+
+    Le fichier est lu en flux et, si la fréquence est donnée,
+    réduit aux variables de cette fréquence.'''
+    # Requête pour la commande
+    section = 'commande'
+    params = {'id-cmde': id_cmde}
+    response = demande(client, section, params=params, frequence='fichier',
+                       stream=True)
+
+    # Commande pas encore prête
+    if response.status_code != desired_status_code:
+        response.close()
+        return None
+
+    # DataFrame de la station
+    df_station = response_flux_to_frame(
+        client, response, frequence=frequence,
+        parse_dates=[client.time_label],
+        index_col=[client.id_station_donnee_label, client.time_label],
+        decimal=',', **read_csv_kwargs)
+
+    return df_station
+
+def iterer_telechargement_des_stations_periode(
     client, df_liste_stations, date_deb_periode, date_fin_periode,
     frequence=None, read_csv_kwargs={},
-    desired_status_code=201, timeout=300, retry_interval=5):
+    desired_status_code=201, timeout=300, retry_interval=5,
+    max_workers=MAX_REQUETES_SIMULTANEES):
+    '''Commande et téléchargement simultanés de la donnée des stations.
+
+    Les commandes en attente sont interrogées ensemble à chaque tour,
+    au plus `max_workers` requêtes à la fois, jusqu'à une échéance commune
+    de `timeout` secondes. Chaque commande prête est lue et renvoyée
+    dès sa réception avec l'identifiant de sa station.'''
     id_commandes = compiler_commandes_des_stations_periode(
         client, df_liste_stations, date_deb_periode, date_fin_periode,
-        frequence=frequence)
-    
-    df = pd.DataFrame(dtype=float)
-    for id_station, id_cmde in id_commandes.items():    
-                
-        # Requête pour la station
-        section = 'commande'
-        params = {'id-cmde': id_cmde}
+        frequence=frequence, max_workers=max_workers)
 
-        start_time = time.time()
+    echeance = time.time() + timeout
+    en_attente = dict(id_commandes)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
         while True:
-            response = demande(client, section, params=params, frequence='fichier')
-            
-            # Check if the status code matches
-            if response.status_code == desired_status_code:
+            # Interrogation de toutes les commandes en attente
+            futures = {
+                executor.submit(
+                    telecharger_commande, client, id_cmde,
+                    frequence=frequence, read_csv_kwargs=read_csv_kwargs,
+                    desired_status_code=desired_status_code): id_station
+                for id_station, id_cmde in en_attente.items()}
+            for future in as_completed(futures):
+                id_station = futures[future]
+                df_station = future.result()
+                if df_station is not None:
+                    del en_attente[id_station]
+                    localisation_temps(df_station)
+                    inserer_noms_stations(client, df_station, df_liste_stations)
+                    yield id_station, df_station
+
+            if not en_attente:
                 break
-            else:
-                print(f"Received status code {response.status_code}. Retrying...")
-        
+            print(f"{len(en_attente):d} commande(s) en attente. Retrying...")
+
             # Check if the timeout has been reached
-            if time.time() - start_time > timeout:
+            if time.time() > echeance:
                 raise requests.exceptions.Timeout(
                     f"Timeout reached after {timeout} seconds "
-                    f"without receiving status code {desired_status_code}.")
+                    f"without receiving status code {desired_status_code} "
+                    f"for stations {list(en_attente)}.")
 
             # Wait before the next attempt
             time.sleep(retry_interval)
 
-        # DataFrame de la station
-        df_station = response_text_to_frame(
-            client, response, parse_dates=[client.time_label],
-            index_col=[client.id_station_donnee_label, client.time_label],
-            decimal=',', **read_csv_kwargs)
-        
-        # Compilation
-        df = pd.concat([df, df_station])
+def compiler_telechargement_des_stations_periode(
+    client, df_liste_stations, date_deb_periode, date_fin_periode, **kwargs):
+    '''Donnée des stations pour la période, concaténée en une seule fois
+    dans l'ordre de la liste des stations.
 
-    localisation_temps(df)
+    Les arguments supplémentaires sont passés à
+    `iterer_telechargement_des_stations_periode`.'''
+    df_stations = dict(iterer_telechargement_des_stations_periode(
+        client, df_liste_stations, date_deb_periode, date_fin_periode,
+        **kwargs))
+    df = pd.concat([df_stations[id_station]
+                    for id_station in df_liste_stations.index])
 
-    inserer_noms_stations(client, df, df_liste_stations)
-        
-    return df      
+    return df
 
-def compiler_donnee_des_departements(
-    client, df_liste_stations, frequence=None):
-    id_departements = liste_id_stations_vers_liste_id_departements(
-        df_liste_stations)
-    df_toutes = pd.DataFrame(dtype=float)
-    params = {'format': FMT}
-    for id_dep in id_departements:
-        # Requête pour la station
-        section = 'paquet'
-        params['id-departement'] = id_dep 
-        response = demande(client, section, params=params, frequence=frequence)
+def lire_departement(client, id_dep, id_stations=None, frequence=None):
+    '''Donnée des stations demandées (toutes si None) d'un département.'''
+    # Requête pour le département
+    section = 'paquet'
+    params = {'format': FMT, 'id-departement': id_dep}
+    response = demande(client, section, params=params, frequence=frequence,
+                       stream=(id_stations is not None))
 
-        # DataFrame pour le département indexé par identifiant station et par date
+    # DataFrame des stations demandées indexé par identifiant station et par date
+    if id_stations is None:
         df_departement = response_text_to_frame(
-            client, response, parse_dates=[client.time_label]).set_index(
-            [client.id_station_donnee_label, client.time_label])
-        
-        # Compilation
-        df_toutes = pd.concat([df_toutes, df_departement])
-
-    # Sélection des stations de la liste
-    df = df_toutes.loc[df_liste_stations.index]
+            client, response, parse_dates=[client.time_label])
+    else:
+        df_departement = response_flux_to_frame_stations(
+            client, response, id_stations, parse_dates=[client.time_label])
+    df_departement = df_departement.set_index(
+        [client.id_station_donnee_label, client.time_label])
+
+    return df_departement
+
+def telecharger_departement(client, id_dep, id_stations, frequence=None):
+    '''Donnée des stations demandées d'un département.
+
+    Avec le cache, la donnée des stations demandées du paquet de l'heure
+    courante est gardée en mémoire pour les clients demandant les mêmes
+    stations du département. Seules ces stations sont lues, le paquet
+    étant partagé par tous les clients via le cache sur disque.'''
+    if client.cache_frames is None:
+        return lire_departement(client, id_dep, id_stations=id_stations,
+                                frequence=frequence)
+
+    # Stations demandées de ce département, qui seules distinguent la clé
+    id_stations_departement = tuple(sorted(
+        id_station for id_station in id_stations
+        if id_station // 1000000 == id_dep))
+    heure = pd.Timestamp.now(tz=TZ).floor('h')
+    cle = (client.api, 'paquet', frequence, int(id_dep), heure.isoformat(),
+           id_stations_departement)
+
+    return client.cache_frames.obtenir(
+        cle, lire_departement, client, id_dep,
+        id_stations=list(id_stations_departement), frequence=frequence,
+        duree_vie=client.cache.durees_vie.get('paquet'))
+
+def iterer_donnee_des_departements(
+    client, df_liste_stations, frequence=None,
+    max_workers=MAX_REQUETES_SIMULTANEES):
+    '''Donnée des stations de la liste, département par département.
+
+    Les paquets des départements sont demandés simultanément et chacun
+    est renvoyé dès sa réception.'''
+    id_departements = liste_id_stations_vers_liste_id_departements(
+        df_liste_stations)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(telecharger_departement, client, id_dep,
+                            df_liste_stations.index, frequence=frequence)
+            for id_dep in id_departements]
+        for future in as_completed(futures):
+            yield future.result()
 
-    # Suppression des duplicatas
+def compiler_donnee_des_departements(
+    client, df_liste_stations, frequence=None,
+    max_workers=MAX_REQUETES_SIMULTANEES):
+    '''Donnée des stations de la liste, concaténée en une seule fois.'''
+    l_df = list(iterer_donnee_des_departements(
+        client, df_liste_stations, frequence=frequence,
+        max_workers=max_workers))
+
+    return assembler_donnee_des_departements(client, l_df, df_liste_stations)
+
+def assembler_donnee_des_departements(client, l_df, df_liste_stations):
+    '''Concaténation de la donnée des départements dans l'ordre de la liste,
+    vide si aucun département n'a été demandé.'''
+    if len(l_df) == 0:
+        return pd.DataFrame(
+            columns=[client.station_name_label],
+            index=pd.MultiIndex.from_arrays(
+                [[], []], names=[client.id_station_donnee_label,
+                                 client.time_label]))
+    df_toutes = pd.concat(l_df)
+
+    # Ordre de la liste des stations, sans celles absentes de la donnée
+    id_stations = df_toutes.index.get_level_values(
+        client.id_station_donnee_label)
+    df = df_toutes.loc[df_liste_stations.index[
+        df_liste_stations.index.isin(id_stations)]]
+
+    # Suppression des duplicatas
     df = df[~df.index.duplicated(keep=False)]
 
     inserer_noms_stations(client, df, df_liste_stations)
@@ -445,10 +858,10 @@ def renommer_variables(client, df, frequence):
 
 def inserer_noms_stations(client, df, df_liste_stations):
     ''' Insertion des noms des stations.'''
-    id_stations_df = df.index.to_frame()[client.id_station_donnee_label]
-    liste_noms_stations = [df_liste_stations.loc[_, client.station_name_label]
-                           for _ in id_stations_df]
-    df.insert(0, client.station_name_label, liste_noms_stations)
+    id_stations_df = df.index.get_level_values(client.id_station_donnee_label)
+    noms_stations = id_stations_df.map(
+        df_liste_stations[client.station_name_label])
+    df.insert(0, client.station_name_label, noms_stations)
 
 def get_str_date(date):
     try:
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import shutil
+
+# Format de stockage par défaut des jeux de données
+FORMAT = 'parquet'
+
+# Suffixe des fichiers pour chaque format
+SUFFIXES = {
+    'parquet': '.parquet',
+    'csv': '.csv'
+}
+
+# Colonne de partition par année des jeux de données temporels
+COLONNE_ANNEE = 'annee'
+
+def get_format(filepath):
+    '''Format d'un fichier d'après son suffixe.'''
+    suffixe = Path(filepath).suffix
+    for fmt, suffixe_fmt in SUFFIXES.items():
+        if suffixe == suffixe_fmt:
+            return fmt
+    raise ValueError(f"Suffixe invalide: {suffixe}. "
+                     f"Les choix possibles sont: {list(SUFFIXES.values())}")
+
+def get_suffixe(fmt=None):
+    '''Suffixe des fichiers pour un format (par défaut `FORMAT`).'''
+    fmt = FORMAT if fmt is None else fmt
+    if fmt not in SUFFIXES:
+        raise ValueError(f"Choix invalide: {fmt}. "
+                         f"Les choix possibles sont: {list(SUFFIXES)}")
+    return SUFFIXES[fmt]
+
+def niveaux_temps(index):
+    '''Noms des niveaux temporels d'un indice.'''
+    levels = index.levels if isinstance(index, pd.MultiIndex) else [index]
+
+    return [name for name, level in zip(index.names, levels)
+            if isinstance(level, pd.DatetimeIndex)]
+
+def colonnes_partition(df):
+    '''Partition par station et par année si l'indice contient le temps.'''
+    names_temps = niveaux_temps(df.index)
+    if len(names_temps) == 0:
+        return []
+    names_stations = [name for name in df.index.names
+                      if name not in names_temps]
+
+    return names_stations + [COLONNE_ANNEE]
+
+def typer_colonnes(df):
+    '''Conversion des réels en float32 et des chaînes en catégories.'''
+    types = {}
+    for colonne, dtype in df.dtypes.items():
+        if pd.api.types.is_float_dtype(dtype):
+            types[colonne] = np.float32
+        elif (pd.api.types.is_object_dtype(dtype) or
+              pd.api.types.is_string_dtype(dtype)):
+            types[colonne] = 'category'
+
+    return df.astype(types)
+
+def ecrire(df, filepath, ajout=False):
+    '''Écriture d'un jeu de données indexé dans le format de son fichier.
+
+    Si `ajout` est vrai, les lignes sont fusionnées avec celles déjà
+    stockées, les nouvelles remplaçant les anciennes de même indice.'''
+    filepath = Path(filepath)
+    fmt = get_format(filepath)
+    if ajout and filepath.exists():
+        df = _fusionner(df, filepath, fmt)
+    elif filepath.is_dir():
+        shutil.rmtree(filepath)
+
+    ECRITURES[fmt](df, filepath)
+
+def _fusionner(df, filepath, fmt):
+    '''Fusion avec les lignes stockées concernées par la nouvelle donnée.'''
+    index_col = list(df.index.names)
+    filtres = None
+    partitions = colonnes_partition(df) if fmt == 'parquet' else []
+    if len(partitions) > 0:
+        # Seules les partitions modifiées sont relues et réécrites
+        valeurs = df.index.to_frame(index=False)
+        name_temps = niveaux_temps(df.index)[0]
+        filtres = [(name, 'in', np.unique(valeurs[name]).tolist())
+                   for name in partitions if name in valeurs]
+        filtres.append((COLONNE_ANNEE, 'in',
+                        np.unique(valeurs[name_temps].dt.year).tolist()))
+    df_existant = lire(filepath, index_col=index_col,
+                       parse_dates=niveaux_temps(df.index), filtres=filtres)
+    df = pd.concat([df_existant, typer_colonnes(df)])
+    df = df[~df.index.duplicated(keep='last')].sort_index()
+
+    return df
+
+def _ecrire_csv(df, filepath):
+    df.to_csv(filepath)
+
+def _ecrire_parquet(df, filepath):
+    partitions = colonnes_partition(df)
+    df_plat = typer_colonnes(df.reset_index())
+    if len(partitions) == 0:
+        df_plat.to_parquet(filepath, index=False)
+    else:
+        df_plat[COLONNE_ANNEE] = df_plat[niveaux_temps(df.index)[0]].dt.year
+        df_plat.to_parquet(
+            filepath, index=False, partition_cols=partitions,
+            existing_data_behavior='delete_matching')
+
+ECRITURES = {
+    'csv': _ecrire_csv,
+    'parquet': _ecrire_parquet
+}
+
+def lire(filepath, index_col=None, parse_dates=None, columns=None,
+         filtres=None):
+    '''Lecture d'un jeu de données dans le format de son fichier.
+
+    Seules les colonnes `columns` (en plus de l'indice) sont lues et,
+    au format parquet, seules les partitions vérifiant les `filtres`
+    (liste de tuples `(colonne, opérateur, valeur)`) sont lues.
+    Un fichier parquet absent est créé à partir du fichier CSV
+    de même nom s'il existe.'''
+    filepath = Path(filepath)
+    fmt = get_format(filepath)
+    if (fmt != 'csv') and (not filepath.exists()):
+        filepath_csv = filepath.with_suffix(SUFFIXES['csv'])
+        if filepath_csv.exists():
+            migrer_csv(filepath_csv, index_col=index_col,
+                       parse_dates=parse_dates, fmt=fmt)
+
+    return LECTURES[fmt](filepath, index_col, parse_dates, columns, filtres)
+
+def _liste(valeur):
+    if valeur is None:
+        return []
+    if isinstance(valeur, (list, tuple)):
+        return list(valeur)
+    return [valeur]
+
+def _lire_csv(filepath, index_col, parse_dates, columns, filtres):
+    if filtres is not None:
+        raise ValueError("Les filtres ne sont disponibles qu'au format parquet.")
+    usecols = None
+    if columns is not None:
+        usecols = _liste(index_col) + list(columns)
+
+    return pd.read_csv(filepath, index_col=index_col, parse_dates=parse_dates,
+                       usecols=usecols)
+
+def _lire_parquet(filepath, index_col, parse_dates, columns, filtres):
+    index_col = _liste(index_col)
+    if columns is not None:
+        columns = index_col + list(columns)
+    df = pd.read_parquet(filepath, columns=columns, filters=filtres)
+
+    # Les colonnes de partition sont relues comme catégories
+    for colonne in index_col:
+        if isinstance(df[colonne].dtype, pd.CategoricalDtype):
+            df[colonne] = df[colonne].astype(
+                df[colonne].cat.categories.dtype)
+    if (COLONNE_ANNEE in df) and (COLONNE_ANNEE not in index_col):
+        df = df.drop(columns=COLONNE_ANNEE)
+
+    if len(index_col) > 0:
+        df = df.set_index(index_col if len(index_col) > 1 else index_col[0])
+        if filepath.is_dir():
+            df = df.sort_index()
+
+    return df
+
+LECTURES = {
+    'csv': _lire_csv,
+    'parquet': _lire_parquet
+}
+
+def migrer_csv(filepath_csv, index_col=None, parse_dates=None, fmt=None):
+    '''Conversion d'un fichier CSV vers le format de stockage.'''
+    filepath_csv = Path(filepath_csv)
+    filepath = filepath_csv.with_suffix(get_suffixe(fmt))
+    df = pd.read_csv(filepath_csv, index_col=index_col,
+                     parse_dates=parse_dates)
+    ecrire(df, filepath)
+
+    return filepath
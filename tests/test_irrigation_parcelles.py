@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import bilan
+import etp
+import irrigation_parcelles
+import meteofrance
+
+# Stations voisines de chacune des deux parcelles (la seconde sans donnée)
+ID_STATION_AVEC_DONNEE = 38185001
+ID_STATION_SANS_DONNEE = 91027002
+
+def ecrire_parcelles(filepath, **colonnes):
+    '''Fichier CSV de deux parcelles, voisines chacune d'une station.'''
+    culture = next(iter(bilan.KC))
+    df_parcelles = pd.DataFrame({
+        'nom': ['avec_meteo', 'sans_meteo'],
+        'latitude': [45.01, 48.61],
+        'longitude': [5.01, 2.31],
+        'altitude': [200., 80.],
+        'culture': [culture, culture],
+        'stade': [next(iter(bilan.KC[culture]))] * 2,
+        'texture': [next(iter(bilan.RU_PAR_CM_DE_TF))] * 2})
+    for colonne, valeurs in colonnes.items():
+        df_parcelles[colonne] = valeurs
+    df_parcelles.to_csv(filepath, index=False)
+
+    return filepath
+
+def test_meteo_inconnue_pour_stations_sans_donnee(monkeypatch, tmp_path):
+    client = meteofrance.Client(
+        irrigation_parcelles.METEOFRANCE_API, application_id='test',
+        cache=False)
+    df_liste_stations = pd.DataFrame(
+        {'Latitude': [45., 48.6], 'Longitude': [5., 2.3]},
+        index=pd.Index([ID_STATION_AVEC_DONNEE, ID_STATION_SANS_DONNEE],
+                       name=client.id_station_label))
+
+    # Seule la première station a de la donnée dans les paquets
+    labels = client.variables_labels[irrigation_parcelles.METEOFRANCE_FREQUENCE]
+    time = pd.date_range('2024-07-01', periods=24, freq='h', tz='UTC')
+    df_meteo = pd.DataFrame({
+        labels['rayonnement_global']: np.clip(
+            3.e6 * np.sin(np.pi * (time.hour - 5) / 14), 0., None),
+        labels['temperature_2m']: 293.15,
+        labels['humidite_relative']: 60.,
+        labels['vitesse_vent_10m']: 2.,
+        labels['precipitation']: 0.},
+        index=pd.MultiIndex.from_product(
+            [[ID_STATION_AVEC_DONNEE], time],
+            names=[client.id_station_donnee_label, client.time_label]))
+
+    monkeypatch.setattr(meteofrance, 'DATA_DIR', tmp_path)
+    monkeypatch.setattr(etp, 'GEOMETRIE_SOLAIRE', etp.GeometrieSolaire(
+        tmp_path / 'geometrie_solaire'))
+    monkeypatch.setattr(meteofrance, 'lire_liste_stations',
+                        lambda *args, **kwargs: df_liste_stations)
+    monkeypatch.setattr(meteofrance, 'compiler_donnee_des_departements',
+                        lambda *args, **kwargs: df_meteo)
+
+    df_parcelles = irrigation_parcelles.lire_parcelles(
+        ecrire_parcelles(tmp_path / 'parcelles.csv'))
+    df_meteo_parcelles = irrigation_parcelles.calcul_meteo_parcelles(
+        client, df_parcelles, rayon_km=20.)
+
+    assert (df_meteo_parcelles['nombre_stations'] == 1).all()
+    variables = list(irrigation_parcelles.VARIABLES_POUR_CALCULS)
+    assert df_meteo_parcelles.loc['avec_meteo', variables].notna().all()
+    assert df_meteo_parcelles.loc['sans_meteo', variables].isna().all()
+
+    df_bilan = irrigation_parcelles.calcul_bilan_parcelles(
+        df_parcelles, df_meteo_parcelles)
+    assert not pd.isna(df_bilan.loc['avec_meteo', 'irrigation'])
+    assert pd.isna(df_bilan.loc['sans_meteo', 'irrigation'])
+
+def test_lire_parcelles_choix_invalides(tmp_path):
+    filepath = ecrire_parcelles(
+        tmp_path / 'parcelles.csv', stade=['Inconnu', None],
+        texture=[next(iter(bilan.RU_PAR_CM_DE_TF)), 'Inconnue'])
+
+    with pytest.raises(ValueError) as erreur:
+        irrigation_parcelles.lire_parcelles(filepath)
+
+    assert "avec_meteo (stade: Inconnu)" in str(erreur.value)
+    assert "sans_meteo (texture: Inconnue)" in str(erreur.value)
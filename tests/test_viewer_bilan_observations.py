@@ -0,0 +1,60 @@
+import panel as pn
+
+import viewer_bilan_observations
+from viewer_bilan_observations import ViewerBilanObservations
+
+class DocumentFactice(object):
+    '''Document Bokeh servi, réduit aux rappels différés.'''
+    def __init__(self):
+        self.session_context = object()
+        self.rappels = {}
+        self._compteur = 0
+
+    def add_timeout_callback(self, rappel, delai_ms):
+        self._compteur += 1
+        self.rappels[self._compteur] = (rappel, delai_ms)
+        return self._compteur
+
+    def remove_timeout_callback(self, identifiant):
+        if identifiant not in self.rappels:
+            raise ValueError(identifiant)
+        del self.rappels[identifiant]
+
+class VueFactice(object):
+    '''Vue réduite à l'état utilisé par le recalcul différé.'''
+    def __init__(self):
+        self._maj_programmee = None
+        self.nombre_maj = 0
+
+    def _maj_plots(self):
+        self._maj_programmee = None
+        self.nombre_maj += 1
+
+def test_programmer_maj_plots_differe_et_regroupe(monkeypatch):
+    doc = DocumentFactice()
+    monkeypatch.setattr(type(pn.state), 'curdoc', doc)
+    vue = VueFactice()
+
+    for _ in range(3):
+        ViewerBilanObservations._programmer_maj_plots(vue)
+
+    # Seul le dernier recalcul reste programmé, après le délai
+    assert vue.nombre_maj == 0
+    assert list(doc.rappels) == [vue._maj_programmee]
+    rappel, delai_ms = doc.rappels.pop(vue._maj_programmee)
+    assert delai_ms == int(1000 * viewer_bilan_observations.DELAI_RECALCUL)
+
+    rappel()
+    assert vue.nombre_maj == 1
+
+    # Recalcul déjà exécuté : le suivant est programmé sans erreur
+    ViewerBilanObservations._programmer_maj_plots(vue)
+    assert len(doc.rappels) == 1
+
+def test_programmer_maj_plots_hors_serveur(monkeypatch):
+    monkeypatch.setattr(type(pn.state), 'curdoc', None)
+    vue = VueFactice()
+
+    ViewerBilanObservations._programmer_maj_plots(vue)
+
+    assert vue.nombre_maj == 1
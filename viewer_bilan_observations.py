@@ -1,4 +1,3 @@
-import pandas as pd
 import panel as pn
 import param
 import plotly.graph_objects as go
@@ -29,6 +28,9 @@ DEFAUT_SEUIL_IRRIGATION = 0.1
 # Conversion de hauteur (mm) vers durée d'irrigation (min)
 DEFAUT_HAUTEUR_VERS_DUREE_IRRIGATION = 10
 
+# Délai (s) sans changement des widgets avant le recalcul du bilan
+DELAI_RECALCUL = 0.3
+
 # Distribution des variables par panel pour le subplot de la météo
 DEFAULT_PANELS_VARIABLES = [
     [
@@ -89,11 +91,19 @@ class ViewerMeteoObservations(View):
     def __init__(self, **params):
         super().__init__(**params)
 
+        # Figure créée une fois, dont seules les données des traces
+        # sont mises à jour à chaque nouvelle donnée de référence
+        self._variables_traces = []
+        self._plot_meteo = pn.pane.Plotly(self._creer_figure_meteo())
+        self._erreur = pn.pane.Str(visible=False)
+        self.datastore.tab_meteo_ref_heure_si.param.watch(
+            self._maj_plots, 'value')
+
         self._sortie_plots = pn.bind(
-            self._creer_plots, self.datastore.param.recuperation_donnee_ref_faite)
+            self._montrer_plots, self.datastore.param.recuperation_donnee_ref_faite)
 
-    def _creer_plot_meteo(
-        self, df,
+    def _creer_figure_meteo(
+        self,
         panels_variables=DEFAULT_PANELS_VARIABLES,
         width=900, height=600
     ):
@@ -114,29 +124,38 @@ class ViewerMeteoObservations(View):
                     params = dict(row=row, col=col, secondary_y=secondary_y)
                     color = DEFAULT_PLOTLY_COLORS[k % len(DEFAULT_PLOTLY_COLORS)]
                     fig.add_trace(
-                        go.Scatter(x=df.index, y=df[variable], line_color=color),
+                        go.Scatter(x=[], y=[], line_color=color),
                         **params)
                     fig.update_yaxes(
                         title_text=name, color=color, **params)
+                    self._variables_traces.append(variable)
         
         fig.update_layout(showlegend=False, width=width, height=height)
     
-        return pn.pane.Plotly(fig)
-
-    def _creer_plots(self, recuperation_donnee_ref_faite):
+        return fig
+
+    def _maj_plots(self, event):
+        df = event.new
+        if len(df) == 0:
+            return
+        try:
+            fig = self._plot_meteo.object
+            with fig.batch_update():
+                for trace, variable in zip(fig.data, self._variables_traces):
+                    trace.update(x=df.index, y=df[variable])
+            self._plot_meteo.param.trigger('object')
+            self._erreur.visible = False
+        except Exception as exc:
+            self._erreur.object = traceback.format_exc()
+            self._erreur.visible = True
+
+    def _montrer_plots(self, recuperation_donnee_ref_faite):
         guide = pn.pane.Alert(
             "Récupérérer la donnée météo de la station de référence "
             "pour pouvoir représenter sa météo...", alert_type="warning")
         sortie = guide
-        if recuperation_donnee_ref_faite:    
-            try:
-                df = self.datastore.tab_meteo_ref_heure_si.value
-                assert len(df) != 0, (
-                    "La table de la donnée météo pour la station de référence est vide!")
-            
-                sortie = self._creer_plot_meteo(df)
-            except Exception as exc:
-                sortie = pn.pane.Str(traceback.format_exc())    
+        if recuperation_donnee_ref_faite:
+            sortie = pn.Column(self._erreur, self._plot_meteo)
         return sortie
 
     def __panel__(self):
@@ -184,34 +203,50 @@ class ViewerBilanObservations(View):
             margin=margin)
 
         # Liaison des stades au choix de culture
-        self._sortie_maj_stades_culture_choisie = pn.bind(
-            self._maj_stades_culture_choisie, self._culture_widget)
+        self._culture_widget.param.watch(
+            self._maj_stades_culture_choisie, 'value')
+
+        # Plots créés une fois, dont seules les données sont mises à jour
+        self._plot_sol = pn.pane.Plotly(self._creer_figure_sol())
+        self._plot_besoin = pn.pane.Plotly(self._creer_figure_besoin())
+        self._plot_titre = pn.pane.Markdown()
+        self._plot_irrigation = pn.pane.Markdown()
+        self._erreur = pn.pane.Str(visible=False)
+        self._sortie_bilan = pn.Column(
+            pn.Row(self._texture_widget,
+                   self._fraction_cailloux_widget),
+            pn.Row(self._fraction_ru_remplie_widget,
+                   self._ru_vers_rfu_widget),
+            pn.Row(self._seuil_irrigation_widget,
+                   self._hauteur_vers_duree_irrigation_widget),
+            pn.Row(self._culture_widget,
+                   self._stade_widget),
+            self._erreur,
+            self._plot_titre,
+            pn.Row(self._plot_sol, self._plot_besoin),
+            self._plot_irrigation
+        )
+
+        # Recalcul différé du bilan au changement des widgets ou de la donnée
+        self._maj_programmee = None
+        for widget in [self._texture_widget, self._fraction_cailloux_widget,
+                       self._fraction_ru_remplie_widget, self._ru_vers_rfu_widget,
+                       self._seuil_irrigation_widget,
+                       self._hauteur_vers_duree_irrigation_widget,
+                       self._culture_widget, self._stade_widget]:
+            widget.param.watch(self._programmer_maj_plots, 'value')
+        self.datastore.tab_meteo_ref_si.param.watch(
+            self._programmer_maj_plots, 'value')
 
-        # Liaison du plot au widgets
         self._sortie_plots = pn.bind(
-            self._creer_plots, self.datastore.param.recuperation_donnee_ref_faite,
-            self._texture_widget, self._fraction_cailloux_widget,
-            self._fraction_ru_remplie_widget, self._ru_vers_rfu_widget,
-            self._seuil_irrigation_widget,
-            self._hauteur_vers_duree_irrigation_widget,
-            self._culture_widget, self._stade_widget
-        )
+            self._montrer_plots, self.datastore.param.recuperation_donnee_ref_faite)
         
-    def _maj_stades_culture_choisie(self, culture_choisie):
-        self._stade_widget.options = list(bilan.KC[culture_choisie])
-        self._stade_widget.value = list(bilan.KC[culture_choisie])[0]
-
-        return self._stade_widget
+    def _maj_stades_culture_choisie(self, event):
+        self._stade_widget.options = list(bilan.KC[event.new])
+        self._stade_widget.value = list(bilan.KC[event.new])[0]
     
-    def _creer_plot_sol(self, s, width=500, height=400):
-        idx_deb = 1
-        idx_fin = 5
-        x = s.index[idx_deb:]
-        s_ru = s.iloc[idx_deb:idx_fin].astype(float).values
-        y = np.concatenate([[s_ru[0]], s_ru[1:] - s_ru[:-1]])
-        measure = ['absolute'] + ['delta'] * (idx_fin - idx_deb - 1)
-        wf = go.Waterfall(x=x, y=y, measure=measure,
-                          texttemplate='%{final:.1f}', cliponaxis=False)
+    def _creer_figure_sol(self, width=500, height=400):
+        wf = go.Waterfall(texttemplate='%{final:.1f}', cliponaxis=False)
         fig = go.Figure(wf)
         fig.update_layout(
             title="Réserve accessible aux racines (valeurs absolues)",
@@ -220,16 +255,20 @@ class ViewerBilanObservations(View):
             height=height
         )
     
-        return pn.pane.Plotly(fig)
+        return fig
 
-    def _creer_plot_besoin(self, s, width=500, height=400):
-        idx_deb = 4
-        idx_fin = 10
+    def _maj_figure_sol(self, s):
+        idx_deb = 1
+        idx_fin = 5
         x = s.index[idx_deb:]
-        y = s.iloc[idx_deb:idx_fin].astype(float)
-        measure = ['absolute'] + ['relative'] * (idx_fin - idx_deb - 2) + ['absolute']
-        wf = go.Waterfall(x=x, y=y, measure=measure,
-                          texttemplate='%{delta:.1f}', cliponaxis=False)
+        s_ru = s.iloc[idx_deb:idx_fin].astype(float).values
+        y = np.concatenate([[s_ru[0]], s_ru[1:] - s_ru[:-1]])
+        measure = ['absolute'] + ['delta'] * (idx_fin - idx_deb - 1)
+        self._plot_sol.object.data[0].update(x=x, y=y, measure=measure)
+        self._plot_sol.param.trigger('object')
+
+    def _creer_figure_besoin(self, width=500, height=400):
+        wf = go.Waterfall(texttemplate='%{delta:.1f}', cliponaxis=False)
         fig = go.Figure(wf)
         fig.update_layout(
             title="Bilan hydrique (différences)",
@@ -238,64 +277,70 @@ class ViewerBilanObservations(View):
             height=height
         )
 
-        return pn.pane.Plotly(fig)
+        return fig
 
-    def _creer_plots(
-        self, recuperation_donnee_ref_faite, texture, fraction_cailloux,
-        fraction_ru_remplie, ru_vers_rfu,
-        seuil_irrigation, hauteur_vers_duree_irrigation,
-        culture, stade
-    ):
+    def _maj_figure_besoin(self, s):
+        idx_deb = 4
+        idx_fin = 10
+        x = s.index[idx_deb:]
+        y = s.iloc[idx_deb:idx_fin].astype(float)
+        measure = ['absolute'] + ['relative'] * (idx_fin - idx_deb - 2) + ['absolute']
+        self._plot_besoin.object.data[0].update(x=x, y=y, measure=measure)
+        self._plot_besoin.param.trigger('object')
+
+    def _programmer_maj_plots(self, *events):
+        '''Recalcul du bilan après DELAI_RECALCUL s sans changement des widgets.'''
+        doc = pn.state.curdoc
+        if (doc is None) or (doc.session_context is None):
+            # Hors serveur (notebook...), mise à jour immédiate
+            self._maj_plots()
+            return
+        if self._maj_programmee is not None:
+            try:
+                doc.remove_timeout_callback(self._maj_programmee)
+            except ValueError:
+                # Recalcul précédent déjà exécuté
+                pass
+        self._maj_programmee = doc.add_timeout_callback(
+            self._maj_plots, int(1000 * DELAI_RECALCUL))
+
+    def _maj_plots(self):
+        self._maj_programmee = None
+        df = self.datastore.tab_meteo_ref_si.value
+        if len(df) == 0:
+            return
+        try:
+            culture = self._culture_widget.value
+            stade = self._stade_widget.value
+            df_bilan = bilan.calcul_bilan(
+                df.iloc[0],
+                self._texture_widget.value, self._fraction_cailloux_widget.value,
+                culture, stade,
+                self._fraction_ru_remplie_widget.value, self._ru_vers_rfu_widget.value,
+                seuil_irrigation=self._seuil_irrigation_widget.value,
+                hauteur_vers_duree_irrigation=(
+                    self._hauteur_vers_duree_irrigation_widget.value))
+
+            self._maj_figure_sol(df_bilan)
+            self._maj_figure_besoin(df_bilan)
+            self._plot_titre.object = (
+                f"### Pour {culture.lower()} au stade {stade.lower()}")
+            self._plot_irrigation.object = ""
+            if df_bilan['irrigation']:
+                self._plot_irrigation.object = (
+                    f"### Besoin d'arroser {df_bilan['duree_irrigation']:.0f} min")
+            self._erreur.visible = False
+        except Exception as exc:
+            self._erreur.object = traceback.format_exc()
+            self._erreur.visible = True
+
+    def _montrer_plots(self, recuperation_donnee_ref_faite):
         guide = pn.pane.Alert(
             "Récupérérer la donnée météo de la station de référence "
             "pour pouvoir exécuter le bilan hydrique...", alert_type="warning")
         sortie = guide
         if recuperation_donnee_ref_faite:
-            try:
-                df = self.datastore.tab_meteo_ref_si.value
-                assert len(df) != 0, (
-                    "La table de la donnée météo pour la station de référence est vide!")
-
-                sortie = pn.Column(
-                    pn.Row(self._texture_widget,
-                           self._fraction_cailloux_widget),
-                    pn.Row(self._fraction_ru_remplie_widget,
-                           self._ru_vers_rfu_widget),
-                    pn.Row(self._seuil_irrigation_widget,
-                           self._hauteur_vers_duree_irrigation_widget),
-                    pn.Row(self._culture_widget,
-                           self._sortie_maj_stades_culture_choisie)
-                )
-            
-                # Get the data
-                df_bilan = bilan.calcul_bilan(
-                    df.iloc[0],
-                    texture, fraction_cailloux,
-                    culture, stade,
-                    fraction_ru_remplie, ru_vers_rfu,
-                    seuil_irrigation=seuil_irrigation,
-                    hauteur_vers_duree_irrigation=hauteur_vers_duree_irrigation)  
-
-                plot_sol = self._creer_plot_sol(df_bilan)
-                plot_besoin = self._creer_plot_besoin(df_bilan)
-                plot_titre = pn.pane.Markdown(
-                    f"### Pour {culture.lower()} au stade {stade.lower()}")
-
-                sortie = pn.Column(
-                    sortie,
-                    plot_titre,
-                    pn.Row(plot_sol, plot_besoin)
-                )
-    
-                if df_bilan['irrigation']:
-                    plot_irrigation = pn.pane.Markdown(
-                        f"### Besoin d'arroser {df_bilan['duree_irrigation']:.0f} min")
-                    sortie = pn.Column(
-                        sortie,
-                        plot_irrigation
-                    )
-            except Exception as exc:
-                sortie = pn.pane.Str(traceback.format_exc())    
+            sortie = self._sortie_bilan
     
         return sortie
         